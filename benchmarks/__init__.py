@@ -0,0 +1,3 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+# Copyright 2016 Timo Schmid
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+# Copyright 2016 Timo Schmid
+"""Import time of the nettcp modules and startup time of the entry points
+
+Every measurement runs in a fresh interpreter. The import time is the
+cumulative time reported by -X importtime, the startup time is the wall time
+of the whole process including the interpreter itself (see the python row).
+
+    python -m benchmarks.bench_import -o import.json
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import sys
+import time
+import subprocess
+
+from .common import write_results, print_table
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = [
+    'nettcp.nmf',
+    'nettcp.trace',
+    'nettcp.stats',
+    'nettcp.pcap',
+    'nettcp.hooks',
+    'nettcp.proxy',
+    'nettcp.stream.nmf',
+    'nettcp.stream.aio',
+    'nettcp.protocol2xml',
+]
+
+
+def environment():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return env
+
+
+def import_time(module, env):
+    """Returns the cumulative import time of module in seconds or None"""
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    _, err = proc.communicate()
+    if proc.returncode:
+        return None
+
+    for line in err.decode().splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split('|')
+        if len(parts) == 3 and parts[2].strip() == module:
+            return int(parts[1]) / 1e6
+    return None
+
+
+def startup_time(module, env):
+    """Returns the wall time of a process importing module in seconds"""
+    code = 'pass' if module is None else 'import ' + module
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, '-c', code],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    proc.communicate()
+    elapsed = time.time() - start
+    if proc.returncode:
+        return None
+    return elapsed
+
+
+def run(args):
+    env = environment()
+    # compile the byte code once, a cold cache is not what we want to measure
+    for module in args.modules:
+        startup_time(module, env)
+
+    results = []
+    for module in [None] + args.modules:
+        startups = [startup_time(module, env) for _ in range(args.repeat)]
+        imports = []
+        if module is not None:
+            imports = [import_time(module, env) for _ in range(args.repeat)]
+
+        if None in startups or None in imports:
+            print('Skipping {}: import failed'.format(module), file=sys.stderr)
+            continue
+
+        results.append({
+            'name': module or 'python',
+            'import_ms': min(imports) * 1000 if imports else None,
+            'startup_ms': min(startups) * 1000,
+        })
+    return results
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'),
+                        help='Write results as JSON to this file')
+    parser.add_argument('-r', '--repeat', type=int, default=10,
+                        help='Best of this many runs (default: 10)')
+    parser.add_argument('modules', nargs='*', default=MODULES,
+                        help='Modules to import (default: all nettcp modules)')
+
+    args = parser.parse_args()
+
+    results = run(args)
+
+    print_table(results, ['name', 'import_ms', 'startup_ms'])
+    if args.output:
+        with args.output as fp:
+            write_results(fp, 'import', results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+# Copyright 2016 Timo Schmid
+"""Micro-benchmarks for the nmf codecs and the trace decoder
+
+Inputs are generated from a fixed seed, so result files of different commits
+can be compared with --compare:
+
+    python -m benchmarks.bench_nmf -o new.json --compare old.json
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import io
+import os
+import sys
+import json
+import random
+import timeit
+import contextlib
+
+from nettcp.nmf import (Record, ViaRecord, SizedEnvelopedMessageRecord,
+                        DataChunk,
+                        varint, varint_encode)
+
+from .common import write_results, print_table
+
+TRACE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                     'example.trace')
+
+
+def payload(size, seed=0):
+    if not size:
+        return b''
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, 'little')
+
+
+def sized(size):
+    data = payload(size)
+    return SizedEnvelopedMessageRecord(Size=len(data), Payload=data)
+
+
+def unsized(size, chunk_size=0x4000):
+    data = payload(size)
+    chunks = [DataChunk(data[i:i + chunk_size])
+              for i in range(0, len(data), chunk_size)]
+    # the record is terminated by an empty chunk
+    return b''.join([b'\x05'] + [c.to_bytes() for c in chunks] + [b'\x00'])
+
+
+def via(url='net.tcp://192.168.56.1:8523/Service1'):
+    return ViaRecord(ViaLength=len(url), Via=url)
+
+
+def read_trace(scale):
+    with open(TRACE) as fp:
+        lines = fp.readlines()
+    return lines * scale
+
+
+def decode_trace(lines):
+    for line in lines:
+        data = bytes.fromhex(line.rstrip('\n').split('\t')[-1])
+        while data:
+            s, obj = Record.parse(data)
+            data = data[s:]
+
+
+def cases(sizes, scale):
+    """Yields (name, size, bytes processed per call, statement)"""
+    for value in (0x7f, 0x3fff, 0x1fffff, 0xfffffff, 0x7ffffffff):
+        encoded = varint_encode(value)
+        yield 'varint', value, len(encoded), lambda e=encoded: varint(None, e)
+        yield 'varint_encode', value, len(encoded), lambda v=value: varint_encode(v)
+
+    rec = via()
+    data = rec.to_bytes()
+    yield 'Record.parse[via]', len(data), len(data), lambda: Record.parse(data)
+    yield 'Record.to_bytes[via]', len(data), len(data), rec.to_bytes
+
+    for size in sizes:
+        rec = sized(size)
+        data = rec.to_bytes()
+        yield ('Record.parse[sized]', size, len(data),
+               lambda d=data: Record.parse(d))
+        yield ('Record.parse_stream[sized]', size, len(data),
+               lambda d=data: Record.parse_stream(io.BytesIO(d)))
+        yield ('Record.parse_stream_lazy[sized]', size, len(data),
+               lambda d=data: Record.parse_stream_lazy(io.BytesIO(d)).to_bytes())
+        yield 'Record.to_bytes[sized]', size, len(data), rec.to_bytes
+
+        data = unsized(size)
+        yield ('Record.parse[unsized]', size, len(data),
+               lambda d=data: Record.parse(d))
+
+        data = DataChunk(payload(size)).to_bytes()
+        yield 'DataChunk.parse', size, len(data), lambda d=data: DataChunk.parse(d)
+
+    lines = read_trace(scale)
+    total = sum(len(l) for l in lines)
+    yield 'trace.decode', len(lines), total, lambda: decode_trace(lines)
+
+    try:
+        from nettcp import protocol2xml
+    except ImportError as e:
+        print('Skipping protocol2xml.parse_line: {}'.format(e), file=sys.stderr)
+        return
+
+    def parse_lines():
+        protocol2xml.dictionary_cache.clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for line in lines:
+                protocol2xml.parse_line(line)
+    yield 'protocol2xml.parse_line', len(lines), total, parse_lines
+
+
+def measure(func, repeat, min_time):
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * min_time / elapsed))
+    timings = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    timings.sort()
+    return number, timings[0], timings[len(timings) // 2]
+
+
+def run(args):
+    results = []
+    for name, size, nbytes, func in cases(args.sizes, args.trace_scale):
+        if args.filter and args.filter not in name:
+            continue
+        number, best, median = measure(func, args.repeat, args.min_time)
+        results.append({
+            'name': name,
+            'size': size,
+            'number': number,
+            'best_us': best * 1e6,
+            'median_us': median * 1e6,
+            'mb_per_sec': nbytes / best / 1e6,
+        })
+    return results
+
+
+def compare(results, previous, threshold):
+    old = dict(((r['name'], r['size']), r) for r in previous['results'])
+    regressions = []
+    for row in results:
+        base = old.get((row['name'], row['size']))
+        if base is None:
+            continue
+        row['change'] = row['best_us'] / base['best_us'] - 1
+        if row['change'] > threshold:
+            regressions.append(row)
+    return regressions
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'),
+                        help='Write results as JSON to this file')
+    parser.add_argument('--compare', type=argparse.FileType('r'),
+                        help='Results of a previous run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='Relative slowdown reported as regression (default: 0.10)')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                        default=[64, 4096, 65536, 1048576, 16777216])
+    parser.add_argument('--trace-scale', type=int, default=100,
+                        help='Repeat example.trace this many times')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='Minimal duration of a single repetition in seconds')
+    parser.add_argument('-k', '--filter', help='Only run benchmarks containing this string')
+
+    args = parser.parse_args()
+
+    results = run(args)
+
+    regressions = []
+    if args.compare:
+        with args.compare as fp:
+            regressions = compare(results, json.load(fp), args.threshold)
+
+    print_table(results, ['name', 'size', 'best_us', 'median_us', 'mb_per_sec', 'change'])
+    if args.output:
+        with args.output as fp:
+            write_results(fp, 'nmf', results)
+
+    for row in regressions:
+        print('REGRESSION: {name}[{size}] {change:+.1%}'.format(**row), file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+# Copyright 2016 Timo Schmid
+"""End-to-end benchmark of NETTCPProxy against a local fake net.tcp service
+
+Every scenario is run twice, once directly against the fake service and once
+through the proxy, so the numbers reported for the proxy can be read as the
+overhead it adds.
+
+    python -m benchmarks.bench_proxy -o proxy.json
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import gc
+import time
+import socket
+import logging
+import threading
+
+from nettcp.stream.socket import SocketStream
+from nettcp.stream.nmf import NMFStream
+from nettcp.nmf import EndRecord
+
+from .fakeserver import FakeNetTcpServer
+from .common import percentile, write_results, print_table
+
+log = logging.getLogger(__name__)
+
+URL = 'net.tcp://127.0.0.1/Service1'
+
+
+def start_proxy(target):
+    from nettcp import proxy
+
+    proxy.TARGET_HOST, proxy.TARGET_PORT = target
+    proxy.NETTCPProxy.negotiate = False
+
+    server = proxy.NETTCPServer(('127.0.0.1', 0))
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+
+def connect(address):
+    s = socket.create_connection(address)
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    stream = NMFStream(SocketStream(s), URL)
+    stream.preamble()
+    return stream
+
+
+def disconnect(stream):
+    # NMFStream.close() does not wait for the EndRecord of the peer
+    stream._inner.write(EndRecord().to_bytes())
+    stream.read_record()
+    stream._inner.close()
+
+
+def run_threads(concurrency, target, *args):
+    errors = []
+
+    def wrapper():
+        try:
+            target(*args)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=wrapper) for _ in range(concurrency)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    if errors:
+        raise errors[0]
+    return elapsed
+
+
+def bench_connections(address, concurrency, total):
+    per_thread = max(total // concurrency, 1)
+
+    def worker():
+        for _ in range(per_thread):
+            disconnect(connect(address))
+
+    elapsed = run_threads(concurrency, worker)
+    return {
+        'connections': per_thread * concurrency,
+        'connections_per_sec': per_thread * concurrency / elapsed,
+    }
+
+
+def bench_messages(address, concurrency, size, count):
+    payload = os.urandom(size)
+    latencies = []
+    lock = threading.Lock()
+
+    def worker():
+        stream = connect(address)
+        local = []
+        for _ in range(count):
+            start = time.time()
+            stream.write(payload)
+            data = stream.read()
+            local.append(time.time() - start)
+            assert data == payload
+        disconnect(stream)
+        with lock:
+            latencies.extend(local)
+
+    elapsed = run_threads(concurrency, worker)
+    return {
+        'messages': len(latencies),
+        'messages_per_sec': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def rss():
+    """Resident set size of this process in bytes, None if unknown
+
+    Unlike tracemalloc this includes the stacks of the proxy threads and the
+    socket buffers, but it is only available on Linux.
+    """
+    try:
+        with open('/proc/self/statm') as fp:
+            pages = int(fp.read().split()[1])
+    except (IOError, OSError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def trim_heap():
+    """Returns freed heap memory to the system (glibc only), RSS then starts low"""
+    try:
+        import ctypes
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (ImportError, OSError, AttributeError):
+        pass
+
+
+def bench_memory(address, concurrency, size, connections):
+    """RSS growth per connection, kept open after echoing one message of size bytes
+
+    The connections are opened by concurrency threads. The fake service, the
+    proxy and the clients share this process, so only the difference to the
+    direct mode is the memory of the proxy.
+    """
+    per_thread = max(connections // concurrency, 1)
+    payload = os.urandom(size)
+    streams = []
+    lock = threading.Lock()
+
+    def worker():
+        for _ in range(per_thread):
+            stream = connect(address)
+            with lock:
+                streams.append(stream)
+            stream.write(payload)
+            assert stream.read() == payload
+
+    gc.collect()
+    trim_heap()
+    before = rss()
+    try:
+        run_threads(concurrency, worker)
+        # give the proxy threads time to settle on their blocking reads
+        time.sleep(0.2)
+        gc.collect()
+        after = rss()
+    finally:
+        for stream in streams:
+            disconnect(stream)
+
+    result = {'connections': len(streams)}
+    if before is not None and after is not None:
+        result['rss_growth_per_connection'] = (after - before) / float(len(streams))
+    return result
+
+
+def run(args):
+    fake = FakeNetTcpServer()
+    targets = [('direct', fake.start())]
+    if not args.direct_only:
+        proxy = start_proxy(fake.server_address)
+        targets.append(('proxy', proxy.server_address))
+
+    results = []
+    for mode, address in targets:
+        for concurrency in args.concurrency:
+            row = {'mode': mode, 'scenario': 'connect', 'concurrency': concurrency}
+            row.update(bench_connections(address, concurrency, args.connections))
+            results.append(row)
+
+            for size in args.sizes:
+                row = {'mode': mode, 'scenario': 'echo',
+                       'concurrency': concurrency, 'size': size}
+                row.update(bench_messages(address, concurrency, size, args.messages))
+                results.append(row)
+
+                row = {'mode': mode, 'scenario': 'memory',
+                       'concurrency': concurrency, 'size': size}
+                row.update(bench_memory(address, concurrency, size,
+                                        args.memory_connections))
+                results.append(row)
+
+    direct = dict(((r['scenario'], r['concurrency'], r.get('size')), r)
+                  for r in results if r['mode'] == 'direct')
+    for row in results:
+        base = direct.get((row['scenario'], row['concurrency'], row.get('size')))
+        if row['mode'] != 'proxy' or base is None:
+            continue
+        if row['scenario'] == 'echo':
+            row['added_p50_ms'] = row['p50_ms'] - base['p50_ms']
+            row['added_p99_ms'] = row['p99_ms'] - base['p99_ms']
+        elif row['scenario'] == 'memory' and 'rss_growth_per_connection' in row:
+            row['added_rss_growth_per_connection'] = \
+                row['rss_growth_per_connection'] - base['rss_growth_per_connection']
+
+    return results
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'),
+                        help='Write results as JSON to this file')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                        default=[64, 1024, 16384, 262144])
+    parser.add_argument('-c', '--concurrency', type=int, nargs='+',
+                        default=[1, 8, 32])
+    parser.add_argument('-m', '--messages', type=int, default=200,
+                        help='Messages per connection')
+    parser.add_argument('-n', '--connections', type=int, default=200,
+                        help='Connections for the connect scenario')
+    parser.add_argument('--memory-connections', type=int, default=100,
+                        help='Connections held open for every memory measurement')
+    parser.add_argument('--direct-only', action='store_true',
+                        help='Only measure the fake service without proxy')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level='WARNING')
+
+    results = run(args)
+
+    print_table(results, ['mode', 'scenario', 'concurrency', 'size',
+                          'connections_per_sec', 'messages_per_sec',
+                          'p50_ms', 'p99_ms', 'added_p50_ms',
+                          'rss_growth_per_connection',
+                          'added_rss_growth_per_connection'])
+    if args.output:
+        with args.output as fp:
+            write_results(fp, 'proxy', results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+# Copyright 2016 Timo Schmid
+from __future__ import print_function, unicode_literals, absolute_import
+
+import sys
+import json
+import platform
+import datetime
+import subprocess
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    idx = int(round((len(values) - 1) * pct / 100.0))
+    return values[idx]
+
+
+def git_revision():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                      stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode().strip()
+
+
+def metadata():
+    return {
+        'date': datetime.datetime.today().isoformat(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+    }
+
+
+def write_results(fp, name, results):
+    json.dump({
+        'benchmark': name,
+        'meta': metadata(),
+        'results': results,
+    }, fp, indent=2, sort_keys=True)
+    fp.write('\n')
+
+
+def print_table(results, columns, file=sys.stderr):
+    widths = [max(len(c), 12) for c in columns]
+    print('  '.join(c.rjust(w) for c, w in zip(columns, widths)), file=file)
+    for row in results:
+        cells = []
+        for c, w in zip(columns, widths):
+            v = row.get(c)
+            if v is None:
+                v = '-'
+            elif isinstance(v, float):
+                v = '{:.3f}'.format(v)
+            cells.append(str(v).rjust(w))
+        print('  '.join(cells), file=file)
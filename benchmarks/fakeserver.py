@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+# Copyright 2016 Timo Schmid
+from __future__ import print_function, unicode_literals, absolute_import
+
+import socket
+import logging
+import threading
+
+try:
+    import SocketServer
+except ImportError:
+    import socketserver as SocketServer
+
+from nettcp.stream.socket import SocketStream, ConnectionClosed
+from nettcp.nmf import (Record, PreambleEndRecord, PreambleAckRecord,
+                        SizedEnvelopedMessageRecord, EndRecord)
+
+log = logging.getLogger(__name__ + '.FakeNetTcpServer')
+
+
+class FakeNetTcpHandler(SocketServer.BaseRequestHandler):
+    """Minimal net.tcp service: acks the preamble and echoes every envelope"""
+
+    def handle(self):
+        try:
+            self.echo(SocketStream(self.request))
+        except (ConnectionClosed, socket.error):
+            pass
+
+    def echo(self, stream):
+        while True:
+            obj = Record.parse_stream(stream)
+
+            if obj.code == PreambleEndRecord.code:
+                stream.write(PreambleAckRecord().to_bytes())
+            elif obj.code == SizedEnvelopedMessageRecord.code:
+                stream.write(obj.to_bytes())
+            elif obj.code == EndRecord.code:
+                stream.write(EndRecord().to_bytes())
+                break
+
+
+class FakeNetTcpServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    # same backlog as NETTCPServer
+    request_queue_size = 128
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        SocketServer.ThreadingTCPServer.__init__(self, address, FakeNetTcpHandler)
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self.server_address
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', '--bind', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8091)
+
+    args = parser.parse_args()
+
+    server = FakeNetTcpServer((args.bind, args.port))
+    log.info('Listening on %s:%d', *server.server_address)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    logging.basicConfig(level='INFO')
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+# Copyright 2016 Timo Schmid
+"""Response cache for idempotent SOAP calls
+
+Requests are keyed by the Via of the connection, the action, the session
+dictionaries of both directions and the request payload without its
+MessageID. A hit is answered from memory with the RelatesTo header of the
+cached response replaced by the MessageID of the new request.
+
+Only messages which don't add strings to the session dictionary are cached,
+otherwise client and server would disagree about the dictionary afterwards.
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from .stats import SessionDictionary, SCAN_ERRORS, scan_headers, mbi31
+from .nmf import ViaRecord, SizedEnvelopedMessageRecord
+
+__all__ = [
+    'ResponseCache',
+    'CacheSession',
+]
+
+log = logging.getLogger(__name__)
+
+
+class ResponseCache(object):
+    """LRU cache with a TTL and a size limit, shared by all sessions"""
+
+    def __init__(self, actions, ttl=60, max_bytes=16 * 1024 * 1024, max_entries=None):
+        self.actions = frozenset(actions)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # key -> (expires, payload, RelatesTo start, RelatesTo end)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= now:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            # most recently used entries are at the end
+            self.entries[key] = self.entries.pop(key)
+            self.hits += 1
+            return entry[1:]
+
+    def put(self, key, payload, start, end, now=None):
+        size = len(payload) + len(key[-1])
+        if size > self.max_bytes:
+            return
+        now = time.time() if now is None else now
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (now + self.ttl, payload, start, end)
+            self.size += size
+            while (self.size > self.max_bytes or
+                   (self.max_entries is not None and len(self.entries) > self.max_entries)):
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.size -= len(entry[1]) + len(key[-1])
+
+    def session(self):
+        return CacheSession(self)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class CachedDictionary(SessionDictionary):
+    """SessionDictionary with a digest of its strings"""
+
+    def __init__(self):
+        SessionDictionary.__init__(self)
+        self.digest = b''
+
+    def update(self, payload):
+        count = len(self.strings)
+        end = SessionDictionary.update(self, payload)
+        if len(self.strings) != count:
+            import hashlib
+            self.digest = hashlib.sha1('\0'.join(self.strings).encode('utf-8')).digest()
+        return end
+
+
+class CacheSession(object):
+    """Looks up requests and stores responses of a single connection"""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.via = None
+        self.dictionaries = {'c>s': CachedDictionary(), 's>c': CachedDictionary()}
+        # MessageID -> key of requests sent to the server
+        self.pending = {}
+
+    def _scan(self, direction, payload, names):
+        """Returns the headers (None if unreadable) and if the message can be cached"""
+        dictionary = self.dictionaries[direction]
+        try:
+            # a message adding strings can't be replayed
+            cacheable = not mbi31(bytearray(payload[:5]), 0)[0]
+            return scan_headers(payload, dictionary, names), cacheable
+        except SCAN_ERRORS:
+            return None, False
+
+    def request(self, obj):
+        """Returns the cached response to obj as a record or None"""
+        if obj.code == ViaRecord.code:
+            self.via = obj.Via
+            return None
+        if obj.code != SizedEnvelopedMessageRecord.code:
+            return None
+
+        payload = obj.Payload
+        headers, cacheable = self._scan('c>s', payload, ('Action', 'MessageID'))
+        if not cacheable or not headers or 'MessageID' not in headers:
+            return None
+        action = headers.get('Action', (None,))[0]
+        if action not in self.cache.actions:
+            return None
+
+        _, start, end = headers['MessageID']
+        key = (self.via, action,
+               self.dictionaries['c>s'].digest,
+               self.dictionaries['s>c'].digest,
+               payload[:start] + payload[end:])
+
+        entry = self.cache.get(key)
+        if entry is None:
+            self.pending[headers['MessageID'][0]] = key
+            return None
+
+        response, rstart, rend = entry
+        # keep the end element flag of the cached text record
+        relates_to = bytearray(payload[start:end])
+        relates_to[0] = (relates_to[0] & ~1) | (bytearray(response[rstart:rstart + 1])[0] & 1)
+        response = response[:rstart] + bytes(relates_to) + response[rend:]
+        log.debug('Answering %s from cache', action)
+        return SizedEnvelopedMessageRecord(Size=len(response), Payload=response)
+
+    def response(self, obj):
+        """Stores the response to a pending request"""
+        if obj.code != SizedEnvelopedMessageRecord.code:
+            return
+
+        payload = obj.Payload
+        headers, cacheable = self._scan('s>c', payload, ('Action', 'RelatesTo'))
+        if not headers or 'RelatesTo' not in headers:
+            return
+        value, start, end = headers['RelatesTo']
+        # forget the request even if its response can't be cached
+        key = self.pending.pop(value, None)
+        if key is None or not cacheable:
+            return
+        if 'fault' in headers.get('Action', ('',))[0].lower():
+            return
+        if key[3] != self.dictionaries['s>c'].digest:
+            # the server added strings while the request was in flight
+            return
+        self.cache.put(key, payload, start, end)
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+# Copyright 2016 Timo Schmid
+"""Optional colored hexdumps, helperlib is only imported for debug output"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import warnings
+
+_print_hexdump = None
+
+
+def get_print_hexdump():
+    """Returns helperlib's print_hexdump or False if it is not installed"""
+    global _print_hexdump
+    if _print_hexdump is None:
+        try:
+            from helperlib import print_hexdump
+        except ImportError:
+            warnings.warn('python-helperlib not installed, no hexdump available (https://github.com/bluec0re/python-helperlib)')
+            print_hexdump = False
+        _print_hexdump = print_hexdump
+    return _print_hexdump
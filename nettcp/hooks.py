@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+# Copyright 2016 Timo Schmid
+"""Record interception hooks for the proxy
+
+A hook is called with the record and the proxy session (NETTCPProxy) and
+returns the record to forward, a list of records to forward instead or None
+to drop it. Rules are compiled into a table keyed by direction and record
+code, records of other types don't pay anything but a dict lookup.
+
+    from nettcp.hooks import Hooks, rewrite, fault
+    from nettcp.nmf import ViaRecord, SizedEnvelopedMessageRecord
+
+    hooks = Hooks()
+    hooks.add('c>s', ViaRecord, rewrite(Via='net.tcp://backend/Service1'))
+    hooks.add('c>s', SizedEnvelopedMessageRecord,
+              fault('http://schemas.microsoft.com/ws/2006/05/framing/faults/ServerTooBusy'),
+              where={'Size': lambda size: size > 1 << 20})
+
+    @hooks.rule('s>c', SizedEnvelopedMessageRecord)
+    def log_response(record, session):
+        print(session.client_address, record.Size)
+        return record
+
+Start the proxy with --hooks mymodule (or --hooks path/to/file.py), the
+module has to define `hooks`.
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import time
+from functools import partial
+
+from .nmf import FaultRecord, utf8, raw_bytes
+
+__all__ = [
+    'Hooks',
+    'drop',
+    'delay',
+    'rewrite',
+    'fault',
+    'fix_lengths',
+    'load_hooks',
+]
+
+DIRECTIONS = ('c>s', 's>c')
+
+
+def _codes(record_types):
+    if not isinstance(record_types, (list, tuple, set)):
+        record_types = [record_types]
+    return [getattr(r, 'code', r) for r in record_types]
+
+
+def _predicate(where):
+    if not where:
+        return None
+    if hasattr(where, '__call__'):
+        return where
+
+    checks = []
+    for name, expected in where.items():
+        if hasattr(expected, '__call__'):
+            checks.append((name, expected))
+        else:
+            checks.append((name, partial(lambda e, v: v == e, expected)))
+
+    def predicate(record):
+        for name, check in checks:
+            if not check(getattr(record, name)):
+                return False
+        return True
+    return predicate
+
+
+class Hooks(object):
+    def __init__(self):
+        self.rules = []
+        self.table = None
+
+    def add(self, direction, record_types, hook, where=None):
+        """Calls hook for records of the given types matching where
+
+        direction is 'c>s', 's>c' or None for both, where is a callable
+        taking the record or a dict mapping field names to the expected
+        value or a callable checking the value.
+        """
+        directions = DIRECTIONS if direction is None else (direction,)
+        for d in directions:
+            if d not in DIRECTIONS:
+                raise ValueError('Unknown direction {!r}'.format(d))
+        self.rules.append((directions, _codes(record_types), hook, _predicate(where)))
+        self.table = None
+
+    def rule(self, direction, record_types, where=None):
+        def decorator(hook):
+            self.add(direction, record_types, hook, where)
+            return hook
+        return decorator
+
+    def compile(self):
+        table = dict((d, {}) for d in DIRECTIONS)
+        for directions, codes, hook, predicate in self.rules:
+            if predicate is not None:
+                hook = partial(_guarded, hook, predicate)
+            for d in directions:
+                for code in codes:
+                    table[d].setdefault(code, []).append(hook)
+        self.table = dict((d, dict((code, tuple(hooks)) for code, hooks in codes.items()))
+                          for d, codes in table.items())
+        return self.table
+
+    def apply(self, direction, record, session):
+        """Returns the records to forward instead of record"""
+        if self.table is None:
+            self.compile()
+
+        hooks = self.table[direction].get(record.code)
+        if not hooks:
+            return (record,)
+
+        code = record.code
+        records = [record]
+        for hook in hooks:
+            result = []
+            for rec in records:
+                if rec.code != code:
+                    # injected records are not matched again
+                    result.append(rec)
+                    continue
+                out = hook(rec, session)
+                if out is None:
+                    continue
+                elif isinstance(out, (list, tuple)):
+                    result.extend(out)
+                else:
+                    result.append(out)
+            records = result
+        return records
+
+
+def _guarded(hook, predicate, record, session):
+    if predicate(record):
+        return hook(record, session)
+    return record
+
+
+def drop():
+    return lambda record, session: None
+
+
+def delay(seconds):
+    def hook(record, session):
+        time.sleep(seconds)
+        return record
+    return hook
+
+
+def fix_lengths(record):
+    """Updates the length fields of string and byte fields of the record"""
+    for name, dtype in record.fields:
+        if isinstance(dtype, partial) and dtype.func in (utf8, raw_bytes):
+            setattr(record, dtype.args[0], len(dtype.encode(getattr(record, name))))
+    return record
+
+
+def rewrite(**fields):
+    def hook(record, session):
+        for name, value in fields.items():
+            setattr(record, name, value)
+        return fix_lengths(record)
+    return hook
+
+
+def fault(uri, to='client'):
+    """Answers the record with a FaultRecord and drops it"""
+    data = FaultRecord(FaultSize=len(uri.encode('utf-8')), Fault=uri).to_bytes()
+
+    def hook(record, session):
+        if to == 'client':
+            session.write_client(data)
+        else:
+            session.write_server(data)
+        return None
+    return hook
+
+
+def load_hooks(name):
+    """Returns the hooks defined in a module or python file"""
+    if name.endswith('.py'):
+        import runpy
+        namespace = runpy.run_path(name)
+    else:
+        import importlib
+        namespace = vars(importlib.import_module(name))
+
+    hooks = namespace.get('hooks')
+    if not isinstance(hooks, Hooks):
+        raise ValueError('{} does not define hooks = Hooks()'.format(name))
+    hooks.compile()
+    return hooks
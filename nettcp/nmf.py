@@ -8,6 +8,8 @@ import enum
 import logging
 from functools import partial
 
+from .stream.socket import BufferLimitExceeded
+
 __all__ = [
     'Record',
     'VersionRecord',
@@ -21,11 +23,15 @@ __all__ = [
     'EndRecord',
     'SizedEnvelopedMessageRecord',
     'UnsizedEnvelopedMessageRecord',
+    'LazyRecord',
     'register_types'
 ]
 
 log = logging.getLogger(__name__)
 
+# value of a field read by a raw reader which has not been decoded yet
+LAZY = object()
+
 
 def b(data):
     return 1, struct.unpack('B', data[:1])[0]
@@ -37,6 +43,8 @@ def pt(func, *args, **kwargs):
         func2.encode = func.encode
     if hasattr(func, 'stream'):
         func2.stream = partial(func.stream, *args, **kwargs)
+    if hasattr(func, 'raw'):
+        func2.raw = partial(func.raw, *args, **kwargs)
     return func2
 
 
@@ -75,6 +83,21 @@ def varint_stream(obj, stream):
 varint.stream = varint_stream
 
 
+def varint_raw(obj, stream):
+    data = b''
+    val = 0
+    shift = 0
+    while True:
+        d = stream.read(1)
+        data += d
+        c = ord(d)
+        val |= (c & 0x7f) << shift
+        if not c & 0x80:
+            return data, val
+        shift += 7
+varint.raw = varint_raw
+
+
 def varint_encode(val):
     if not val:
         return b'\x00'
@@ -112,6 +135,7 @@ def utf8_stream(name, obj, stream):
     l = getattr(obj, name)
     return stream.read(l).decode('utf-8')
 utf8.stream = utf8_stream
+utf8.raw = lambda name, obj, stream: (stream.read(getattr(obj, name)), LAZY)
 
 
 def raw_bytes(name, obj, data):
@@ -124,6 +148,7 @@ def raw_bytes_stream(name, obj, stream):
     l = getattr(obj, name)
     return stream.read(l)
 raw_bytes.stream = raw_bytes_stream
+raw_bytes.raw = lambda name, obj, stream: (stream.read(getattr(obj, name)), LAZY)
 
 
 def data_chunks(obj, data):
@@ -150,6 +175,25 @@ def data_chunks_stream(obj, stream):
 data_chunks.stream = data_chunks_stream
 
 
+def data_chunks_raw(obj, stream):
+    # max_read of the stream limits the whole record, not just one chunk
+    limit = getattr(stream, 'max_read', None)
+    total = 0
+    data = []
+    while True:
+        size, value = varint_raw(obj, stream)
+        data.append(size)
+        if not value:
+            break
+        total += value
+        if limit is not None and total > limit:
+            raise BufferLimitExceeded('Refusing to buffer more than {} bytes of chunks'.format(
+                limit))
+        data.append(stream.read(value))
+    return b''.join(data), LAZY
+data_chunks.raw = data_chunks_raw
+
+
 def as_enum(fmt, enum):
     def internal(obj, data):
         s = struct.calcsize(fmt)
@@ -161,10 +205,14 @@ def as_enum(fmt, enum):
         value = struct.unpack(fmt, stream.read(s))[0]
         return enum(value)
 
-    def encode(enum):
-        return struct.pack(fmt, enum.value)
+    def encode(value):
+        return struct.pack(fmt, int(value))
+
+    def raw(obj, stream):
+        return stream.read(struct.calcsize(fmt)), LAZY
 
     internal.stream = stream
+    internal.raw = raw
     internal.encode = encode
     return internal
 
@@ -218,7 +266,16 @@ class DataChunk:
         return 'DataChunk({!r})'.format(self.data)
 
 
-class Record(object):
+class RecordType(type):
+    """Registers every record class defining a code when it is created"""
+
+    def __init__(cls, name, bases, namespace):
+        super(RecordType, cls).__init__(name, bases, namespace)
+        if namespace.get('code') is not None:
+            cls.register(cls)
+
+
+class Record(RecordType(str('RecordBase'), (object,), {})):
     code_fmt = 'B'
     code = None
     fields = []
@@ -274,6 +331,43 @@ class Record(object):
 
         return obj
 
+    @classmethod
+    def parse_stream_lazy(cls, stream):
+        """Reads a record without decoding its fields, see LazyRecord"""
+        s = struct.calcsize(cls.code_fmt)
+        data = stream.read(s)
+        assert len(data) == s, repr(data)
+        code = struct.unpack(cls.code_fmt, data)[0]
+
+        rec = cls._records[code]
+
+        obj = LazyRecord(rec)
+        if not rec.fields:
+            obj.__dict__['_raw'] = data
+            return obj
+
+        values = obj.__dict__
+        spans = values['_spans']
+        parts = [data]
+        for name, dtype in rec.fields:
+            reader = getattr(dtype, 'raw', None)
+            if reader is not None:
+                raw, val = reader(obj, stream)
+                if val is not LAZY:
+                    values[name] = val
+            else:
+                raw = stream.read(struct.calcsize(dtype))
+            spans[name] = (dtype, s, s + len(raw))
+            s += len(raw)
+            parts.append(raw)
+
+        values['_raw'] = b''.join(parts)
+        return obj
+
+    def field_bytes(self, name):
+        """Returns the value of a bytes field (a view of it for lazy records)"""
+        return getattr(self, name)
+
     def to_bytes(self):
         data = struct.pack(self.code_fmt, self.code)
         for name, dtype in self.fields:
@@ -297,6 +391,64 @@ class Record(object):
         return '{}({})'.format(type(self).__name__, ', '.join(fields))
 
 
+class LazyRecord(Record):
+    """Record keeping its raw bytes, fields are decoded on first access
+
+    Forwarding a record only needs code and to_bytes(), which returns the
+    bytes as read. Assigning a field decodes the remaining fields and lets
+    to_bytes() encode the record again.
+    """
+
+    def __init__(self, record_type):
+        values = self.__dict__
+        values['_type'] = record_type
+        values['_raw'] = None
+        values['_spans'] = {}
+        values['code'] = record_type.code
+        values['fields'] = record_type.fields
+
+    def __getattr__(self, name):
+        try:
+            dtype, start, end = self.__dict__['_spans'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+        data = self._raw[start:end]
+        if hasattr(dtype, '__call__'):
+            _, val = dtype(self, data)
+        else:
+            val = struct.unpack(dtype, data)[0]
+        self.__dict__[name] = val
+        return val
+
+    def field_bytes(self, name):
+        """Returns the raw bytes of a field as memoryview, without copying"""
+        span = self.__dict__['_spans'].get(name)
+        if self._raw is None or span is None or name in self.__dict__:
+            return Record.field_bytes(self, name)
+        return memoryview(self._raw)[span[1]:span[2]]
+
+    def __setattr__(self, name, value):
+        if self._raw is not None:
+            for field, _ in self.fields:
+                getattr(self, field)
+            self.__dict__['_raw'] = None
+        self.__dict__[name] = value
+
+    def to_bytes(self):
+        if self._raw is not None:
+            return self._raw
+        return super(LazyRecord, self).to_bytes()
+
+    def __repr__(self):
+        fields = [
+            '{}={!r}'.format(name, getattr(self, name))
+            for name, _ in self.fields
+        ]
+
+        return '{}({})'.format(self._type.__name__, ', '.join(fields))
+
+
 class VersionRecord(Record):
     code = 0x00
     fields = [
@@ -375,18 +527,7 @@ class UnsizedEnvelopedMessageRecord(Record):
 
 
 def register_types(module=None, baseclass=Record):
-    import inspect
-
-    if not module:
-        module = __name__
-
-    if isinstance(module, str):
-        import sys
-        module = sys.modules[module]
-
-    for name, cls in inspect.getmembers(module, inspect.isclass):
-        if issubclass(cls, baseclass):
-            baseclass.register(cls)
+    """Records register themselves, kept for compatibility"""
 
 
 def main():
@@ -397,8 +538,6 @@ def main():
 
     args = parser.parse_args()
 
-    register_types()
-
     for line in args.TRACE_FILE:
         parts = line.strip().split('\t')
         if len(parts) == 2:
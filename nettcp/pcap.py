@@ -0,0 +1,544 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+# Copyright 2016 Timo Schmid
+"""Reads net.tcp sessions from pcap/pcapng captures and writes traces as pcap
+
+Captures are processed packet by packet: TCP streams are reassembled per
+flow with a bounded buffer and every complete record is handed out as soon
+as it is available, so captures larger than memory can be decoded.
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import sys
+import socket
+import struct
+import logging
+import datetime
+
+from .trace import parse_line, format_line
+from .nmf import UpgradeResponseRecord
+from .stream.framing import RecordReader
+
+__all__ = [
+    'read_packets',
+    'read_records',
+    'PcapWriter',
+    'pcap_to_trace',
+    'trace_to_pcap',
+]
+
+log = logging.getLogger(__name__)
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+PCAPNG_MAGIC = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER = 0x1a2b3c4d
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_PSH = 0x08
+TCP_ACK = 0x10
+
+# largest record or out-of-order data kept per direction of a flow
+MAX_BUFFER = 64 * 1024 * 1024
+# capture seconds without a packet after which a flow is forgotten
+FLOW_TIMEOUT = 600
+# flows tracked at once, the least recently active ones are forgotten beyond
+MAX_FLOWS = 100000
+
+
+class CaptureError(ValueError):
+    pass
+
+
+def _read(fp, size):
+    data = fp.read(size)
+    if len(data) < size:
+        raise EOFError
+    return data
+
+
+def _read_pcap(fp, magic):
+    for endian in '<>':
+        value = struct.unpack(endian + 'I', magic)[0]
+        if value in (PCAP_MAGIC, PCAP_MAGIC_NS):
+            break
+    scale = 1e-9 if value == PCAP_MAGIC_NS else 1e-6
+
+    _, _, _, _, _, linktype = struct.unpack(endian + 'HHiIII', _read(fp, 20))
+    header = struct.Struct(endian + 'IIII')
+    while True:
+        try:
+            sec, frac, caplen, _ = header.unpack(_read(fp, header.size))
+            data = _read(fp, caplen)
+        except EOFError:
+            return
+        yield sec + frac * scale, linktype, data
+
+
+def _read_pcapng(fp, magic):
+    endian = '<'
+    interfaces = []
+    block_type = PCAPNG_MAGIC
+    while True:
+        try:
+            if block_type is None:
+                block_type = struct.unpack(endian + 'I', _read(fp, 4))[0]
+            length = _read(fp, 4)
+            if block_type == PCAPNG_MAGIC:
+                order = _read(fp, 4)
+                endian = '<' if struct.unpack('<I', order)[0] == PCAPNG_BYTE_ORDER else '>'
+                length = struct.unpack(endian + 'I', length)[0]
+                body = order + _read(fp, length - 12)
+            else:
+                length = struct.unpack(endian + 'I', length)[0]
+                body = _read(fp, length - 8)
+        except EOFError:
+            return
+
+        body = body[:-4]
+        if block_type == PCAPNG_MAGIC:
+            interfaces = []
+        elif block_type == 1:
+            linktype = struct.unpack(endian + 'H', body[:2])[0]
+            interfaces.append((linktype, _tsresol(body[8:], endian)))
+        elif block_type == 6:
+            iface, high, low, caplen, _ = struct.unpack(endian + 'IIIII', body[:20])
+            linktype, scale = interfaces[iface]
+            yield ((high << 32) | low) * scale, linktype, body[20:20 + caplen]
+        elif block_type == 3 and interfaces:
+            caplen = len(body) - 4
+            linktype, _ = interfaces[0]
+            yield 0, linktype, body[4:4 + caplen]
+        block_type = None
+
+
+def _tsresol(options, endian):
+    pos = 0
+    while pos + 4 <= len(options):
+        code, length = struct.unpack(endian + 'HH', options[pos:pos + 4])
+        if code == 0:
+            break
+        if code == 9:
+            value = bytearray(options[pos + 4:pos + 5])[0]
+            if value & 0x80:
+                return 2 ** -(value & 0x7f)
+            return 10 ** -value
+        pos += 4 + ((length + 3) & ~3)
+    return 1e-6
+
+
+def read_packets(fp):
+    """Yields (timestamp, linktype, frame) of a pcap or pcapng file"""
+    magic = _read(fp, 4)
+    values = struct.unpack('<I', magic) + struct.unpack('>I', magic)
+    if values[0] == PCAPNG_MAGIC:
+        return _read_pcapng(fp, magic)
+    if PCAP_MAGIC in values or PCAP_MAGIC_NS in values:
+        return _read_pcap(fp, magic)
+    raise CaptureError('Not a pcap or pcapng file')
+
+
+def parse_frame(linktype, frame):
+    """Returns (src, dst, seq, flags, payload) of a TCP segment or None"""
+    if linktype == LINKTYPE_ETHERNET:
+        ethertype = struct.unpack('>H', frame[12:14])[0]
+        pos = 14
+        while ethertype in ETHERTYPE_VLAN:
+            ethertype = struct.unpack('>H', frame[pos + 2:pos + 4])[0]
+            pos += 4
+        frame = frame[pos:]
+    elif linktype == LINKTYPE_LINUX_SLL:
+        ethertype = struct.unpack('>H', frame[14:16])[0]
+        frame = frame[16:]
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        ethertype = struct.unpack('>H', frame[:2])[0]
+        frame = frame[20:]
+    elif linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        # address family in host byte order of the capturing machine
+        family = struct.unpack('<I', frame[:4])[0]
+        if family > 0xffff:
+            family = struct.unpack('>I', frame[:4])[0]
+        ethertype = ETHERTYPE_IPV4 if family == 2 else ETHERTYPE_IPV6
+        frame = frame[4:]
+    elif linktype == LINKTYPE_RAW:
+        ethertype = ETHERTYPE_IPV6 if bytearray(frame[:1])[0] >> 4 == 6 else ETHERTYPE_IPV4
+    else:
+        return None
+
+    if ethertype == ETHERTYPE_IPV4:
+        if len(frame) < 20:
+            return None
+        ihl = (bytearray(frame[:1])[0] & 0x0f) * 4
+        total, = struct.unpack('>H', frame[2:4])
+        fragment, proto = struct.unpack('>H', frame[6:8])[0], bytearray(frame[9:10])[0]
+        if proto != 6 or fragment & 0x3fff:
+            # fragmented segments are not supported
+            return None
+        src = socket.inet_ntoa(frame[12:16])
+        dst = socket.inet_ntoa(frame[16:20])
+        segment = frame[ihl:total or None]
+    elif ethertype == ETHERTYPE_IPV6:
+        if len(frame) < 40:
+            return None
+        length, proto = struct.unpack('>HB', frame[4:7])
+        src = socket.inet_ntop(socket.AF_INET6, frame[8:24])
+        dst = socket.inet_ntop(socket.AF_INET6, frame[24:40])
+        segment = frame[40:40 + length]
+        # hop-by-hop, routing and destination options
+        while proto in (0, 43, 60) and len(segment) >= 8:
+            proto = bytearray(segment[:1])[0]
+            segment = segment[(bytearray(segment[1:2])[0] + 1) * 8:]
+        if proto != 6:
+            return None
+    else:
+        return None
+
+    if len(segment) < 20:
+        return None
+    sport, dport, seq, _, offset, flags = struct.unpack('>HHIIBB', segment[:14])
+    return (src, sport), (dst, dport), seq, flags, segment[(offset >> 4) * 4:]
+
+
+class Direction(object):
+    """Reassembles one direction of a TCP stream into NMF records"""
+
+    def __init__(self, max_buffer=MAX_BUFFER):
+        self.max_buffer = max_buffer
+        self.next_seq = None
+        self.segments = {}
+        self.segments_size = 0
+        self.records = RecordReader()
+        self.opaque = False
+
+    def syn(self, seq):
+        self.next_seq = (seq + 1) & 0xffffffff
+
+    def feed(self, seq, data):
+        """Adds a segment, returns the records completed by it"""
+        if self.opaque or not data:
+            return []
+        if self.next_seq is None:
+            # capture started within the connection
+            self.next_seq = seq
+
+        offset = (seq - self.next_seq) & 0xffffffff
+        if offset >= 0x80000000:
+            # retransmission of (partially) delivered data
+            data = data[(self.next_seq - seq) & 0xffffffff:]
+            if not data:
+                return []
+            offset = 0
+
+        if offset:
+            stored = self.segments.get(seq)
+            if stored is None or len(stored) < len(data):
+                self.segments[seq] = data
+                self.segments_size += len(data) - (len(stored) if stored else 0)
+                self._check_size()
+            return []
+
+        self.records.feed(data)
+        self.next_seq = (self.next_seq + len(data)) & 0xffffffff
+        self._reassemble()
+        self._check_size()
+        return self._records()
+
+    def _reassemble(self):
+        """Appends the stored segments reached by next_seq"""
+        while self.segments:
+            progress = False
+            for seq in list(self.segments):
+                # retransmissions may be split at other boundaries, so a
+                # segment can start before next_seq
+                offset = (self.next_seq - seq) & 0xffffffff
+                if offset >= 0x80000000:
+                    continue
+                data = self.segments.pop(seq)
+                self.segments_size -= len(data)
+                if offset < len(data):
+                    self.records.feed(data[offset:])
+                    self.next_seq = (self.next_seq + len(data) - offset) & 0xffffffff
+                    progress = True
+            if not progress:
+                break
+
+    def _check_size(self):
+        if len(self.records) + self.segments_size > self.max_buffer:
+            log.warning('Flow exceeds buffer limit of %d bytes, not decoding it', self.max_buffer)
+            self.close()
+
+    def close(self):
+        self.opaque = True
+        self.records = RecordReader()
+        self.segments = {}
+        self.segments_size = 0
+
+    def _records(self):
+        records = []
+        while not self.opaque:
+            try:
+                result = self.records.read()
+            except IOError as e:
+                log.warning('%s, not decoding flow', e)
+                self.close()
+                break
+            if result is None:
+                break
+
+            records.append(result)
+            if result[1].code == UpgradeResponseRecord.code:
+                # everything after the upgrade is wrapped by the negotiate stream
+                self.close()
+        return records
+
+
+class Flow(object):
+    def __init__(self, client, server, max_buffer=MAX_BUFFER):
+        self.client = client
+        self.server = server
+        self.directions = {
+            'c>s': Direction(max_buffer),
+            's>c': Direction(max_buffer),
+        }
+        self.finished = set()
+        # capture time of the last packet
+        self.last = None
+
+
+def expire_flows(flows, before):
+    """Forgets the flows without a packet since the capture time before"""
+    for key in [k for k, flow in flows.items() if flow.last < before]:
+        del flows[key]
+
+
+def limit_flows(flows, max_flows):
+    """Forgets the least recently active tenth of the flows beyond max_flows"""
+    if len(flows) < max_flows:
+        return
+    keys = sorted(flows, key=lambda k: flows[k].last)
+    for key in keys[:max(len(keys) // 10, 1)]:
+        del flows[key]
+
+
+def read_records(fp, ports=None, max_buffer=MAX_BUFFER, flow_timeout=FLOW_TIMEOUT,
+                 max_flows=MAX_FLOWS):
+    """Yields (timestamp, client, direction, data, record) of a capture
+
+    ports restricts decoding to connections with one of the given server
+    ports, otherwise the side sending the SYN is considered the client.
+    Flows without FIN or RST are forgotten after flow_timeout seconds of
+    capture time without packets or when there are more than max_flows.
+    """
+    flows = {}
+    expire_at = None
+    for timestamp, linktype, frame in read_packets(fp):
+        if flow_timeout is not None:
+            if expire_at is None:
+                expire_at = timestamp + flow_timeout
+            elif timestamp >= expire_at:
+                expire_flows(flows, timestamp - flow_timeout)
+                expire_at = timestamp + flow_timeout
+
+        try:
+            tcp = parse_frame(linktype, frame)
+        except (struct.error, IndexError, ValueError):
+            continue
+        if tcp is None:
+            continue
+        src, dst, seq, flags, payload = tcp
+
+        key = (src, dst) if src < dst else (dst, src)
+        flow = flows.get(key)
+        if flow is None:
+            if not payload and not flags & TCP_SYN:
+                # ACKs, FINs and RSTs of flows which ended or were forgotten
+                continue
+            if ports and dst[1] not in ports and src[1] not in ports:
+                continue
+            if max_flows is not None:
+                limit_flows(flows, max_flows)
+            if ports:
+                client, server = (src, dst) if dst[1] in ports else (dst, src)
+            elif flags & (TCP_SYN | TCP_ACK) == TCP_SYN | TCP_ACK:
+                client, server = dst, src
+            else:
+                client, server = src, dst
+            flow = flows[key] = Flow(client, server, max_buffer)
+
+        flow.last = timestamp
+        direction = 'c>s' if src == flow.client else 's>c'
+        side = flow.directions[direction]
+        if flags & TCP_SYN:
+            side.syn(seq)
+
+        for data, obj in side.feed(seq, payload):
+            yield timestamp, flow.client, direction, data, obj
+
+        if flags & TCP_RST:
+            flow.finished.update(flow.directions)
+        elif flags & TCP_FIN:
+            flow.finished.add(direction)
+        if len(flow.finished) == 2:
+            del flows[key]
+
+
+def pcap_to_trace(fp, out, ports=None, max_buffer=MAX_BUFFER, flow_timeout=FLOW_TIMEOUT):
+    """Writes the records of a capture in the trace format of the proxy"""
+    for timestamp, client, direction, data, _ in read_records(fp, ports, max_buffer,
+                                                              flow_timeout):
+        out.write(format_line(timestamp, client, direction, data))
+
+
+def checksum(data):
+    if len(data) & 1:
+        data += b'\x00'
+    total = sum(struct.unpack('>{}H'.format(len(data) // 2), data))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+class PcapWriter(object):
+    """Writes synthetic TCP/IP packets of reassembled streams (LINKTYPE_RAW)"""
+    # keep segments below the maximum IP packet size
+    mss = 65000
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.fp.write(struct.pack('<IHHiIII', PCAP_MAGIC, 2, 4, 0, 0, 0xffff, LINKTYPE_RAW))
+        self.connections = {}
+
+    def packet(self, timestamp, src, dst, seq, ack, flags, payload=b''):
+        v6 = ':' in src[0]
+        tcp = struct.pack('>HHIIBBHHH', src[1], dst[1], seq, ack, 5 << 4, flags,
+                          0xffff, 0, 0)
+        if v6:
+            addresses = socket.inet_pton(socket.AF_INET6, src[0]) + \
+                socket.inet_pton(socket.AF_INET6, dst[0])
+            pseudo = addresses + struct.pack('>IxxxB', len(tcp) + len(payload), 6)
+        else:
+            addresses = socket.inet_aton(src[0]) + socket.inet_aton(dst[0])
+            pseudo = addresses + struct.pack('>xBH', 6, len(tcp) + len(payload))
+        tcp = tcp[:16] + struct.pack('>H', checksum(pseudo + tcp + payload)) + tcp[18:]
+
+        if v6:
+            ip = struct.pack('>IHBB', 6 << 28, len(tcp) + len(payload), 6, 64) + addresses
+        else:
+            ip = struct.pack('>BBHHHBBH', 0x45, 0, 20 + len(tcp) + len(payload),
+                             0, 0x4000, 64, 6, 0) + addresses
+            ip = ip[:10] + struct.pack('>H', checksum(ip)) + ip[12:]
+
+        data = ip + tcp + payload
+        sec = int(timestamp)
+        self.fp.write(struct.pack('<IIII', sec, int(round((timestamp - sec) * 1e6)),
+                                  len(data), len(data)))
+        self.fp.write(data)
+
+    def write(self, timestamp, client, server, direction, data):
+        conn = self.connections.get((client, server))
+        if conn is None:
+            # handshake with fixed initial sequence numbers
+            conn = self.connections[(client, server)] = {'c>s': 1001, 's>c': 5001}
+            self.packet(timestamp, client, server, 1000, 0, TCP_SYN)
+            self.packet(timestamp, server, client, 5000, 1001, TCP_SYN | TCP_ACK)
+            self.packet(timestamp, client, server, 1001, 5001, TCP_ACK)
+
+        src, dst = (client, server) if direction == 'c>s' else (server, client)
+        other = 's>c' if direction == 'c>s' else 'c>s'
+        for i in range(0, len(data), self.mss):
+            chunk = data[i:i + self.mss]
+            self.packet(timestamp, src, dst, conn[direction], conn[other],
+                        TCP_PSH | TCP_ACK, chunk)
+            conn[direction] = (conn[direction] + len(chunk)) & 0xffffffff
+
+    def close(self, timestamp):
+        for (client, server), conn in self.connections.items():
+            self.packet(timestamp, client, server, conn['c>s'], conn['s>c'], TCP_FIN | TCP_ACK)
+            self.packet(timestamp, server, client, conn['s>c'], conn['c>s'] + 1, TCP_FIN | TCP_ACK)
+        self.connections = {}
+
+
+def split_address(value):
+    host, port = value.rsplit(':', 1)
+    return host.strip('[]'), int(port)
+
+
+def trace_to_pcap(lines, fp, server=('127.0.0.1', 808)):
+    """Converts trace lines of the proxy into a pcap file
+
+    The trace does not contain the address of the server, all connections
+    are written as going to server.
+    """
+    writer = PcapWriter(fp)
+    last = 0
+    for line in lines:
+        timestamp, client, dir, data = parse_line(line)
+        if timestamp is None:
+            # old trace format without timestamp and client
+            timestamp, client = last, '127.0.0.1:1'
+        last = timestamp
+        writer.write(timestamp, split_address(client), server, dir, data)
+    writer.close(last)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('import', help='Convert a capture into a trace')
+    p.add_argument('CAPTURE', type=argparse.FileType('rb'))
+    p.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout)
+    p.add_argument('-p', '--port', type=int, action='append',
+                   help='Server port of the net.tcp service (repeatable)')
+    p.add_argument('--max-buffer', type=int, default=MAX_BUFFER, metavar='BYTES',
+                   help='Bytes buffered per flow direction before giving up on it')
+    p.add_argument('--flow-timeout', type=float, default=FLOW_TIMEOUT, metavar='SECONDS',
+                   help='Forget flows without packets for this long (default: {})'.format(
+                       FLOW_TIMEOUT))
+
+    p = sub.add_parser('decode', help='Print the records of a capture')
+    p.add_argument('CAPTURE', type=argparse.FileType('rb'))
+    p.add_argument('-p', '--port', type=int, action='append')
+    p.add_argument('--max-buffer', type=int, default=MAX_BUFFER, metavar='BYTES')
+    p.add_argument('--flow-timeout', type=float, default=FLOW_TIMEOUT, metavar='SECONDS')
+
+    p = sub.add_parser('export', help='Convert a trace into a pcap file')
+    p.add_argument('TRACE_FILE', type=argparse.FileType('r'))
+    p.add_argument('-o', '--output', type=argparse.FileType('wb'), required=True)
+    p.add_argument('-s', '--server', type=split_address, default=('127.0.0.1', 808),
+                   help='Address used for the server side (default: 127.0.0.1:808)')
+
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        with args.CAPTURE as fp:
+            pcap_to_trace(fp, args.output, args.port, args.max_buffer, args.flow_timeout)
+    elif args.command == 'decode':
+        with args.CAPTURE as fp:
+            records = read_records(fp, args.port, args.max_buffer, args.flow_timeout)
+            for timestamp, client, dir, _, obj in records:
+                print(datetime.datetime.fromtimestamp(timestamp),
+                      '{}:{}'.format(*client), dir, obj)
+    elif args.command == 'export':
+        with args.TRACE_FILE as lines, args.output as fp:
+            trace_to_pcap(lines, fp, args.server)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
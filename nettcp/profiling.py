@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+# Copyright 2016 Timo Schmid
+"""Stage timing and sampling profiler for the proxy
+
+Every connection gets one Stages per direction which the forwarding thread
+of that direction updates without a lock: recv, decrypt, parse, stats,
+hooks, cache, encode, trace, log, encrypt and send. The Profiler reports the
+stages of every open connection and the sum of the finished ones.
+
+The sampling profiler periodically records the stacks of all threads (unlike
+cProfile, which only sees the thread it was enabled in) and writes them in
+the folded format understood by flamegraph.pl and speedscope.
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import sys
+import time
+import logging
+import threading
+from collections import Counter
+
+__all__ = [
+    'clock',
+    'Stages',
+    'Profiler',
+    'sample_stacks',
+]
+
+log = logging.getLogger(__name__)
+
+clock = getattr(time, 'perf_counter', time.time)
+
+DIRECTIONS = ('c>s', 's>c')
+
+
+def _address(client_address):
+    return '{}:{}'.format(*client_address[:2])
+
+
+class Stages(object):
+    """Cumulative seconds and calls per stage of one direction"""
+
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self.last = clock()
+
+    def add(self, stage, seconds):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def mark(self):
+        self.last = clock()
+
+    def lap(self, stage):
+        """Adds the time since the last mark or lap to stage"""
+        now = clock()
+        self.add(stage, now - self.last)
+        self.last = now
+
+    def get(self, stage):
+        return self.seconds.get(stage, 0.0)
+
+    def merge(self, other):
+        for stage, seconds in list(other.seconds.items()):
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            self.calls[stage] = self.calls.get(stage, 0) + other.calls.get(stage, 0)
+
+    def to_dict(self):
+        return dict((stage, {'seconds': seconds, 'calls': self.calls.get(stage, 0)})
+                    for stage, seconds in self.seconds.items())
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '{}:{}:{}'.format(os.path.basename(code.co_filename), code.co_name,
+                             frame.f_lineno)
+
+
+def sample_stacks(duration, interval=0.005):
+    """Returns a Counter of folded stacks of all other threads"""
+    me = threading.current_thread().ident
+    names = dict((t.ident, t.name) for t in threading.enumerate())
+    stacks = Counter()
+    end = clock() + duration
+    while clock() < end:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, 'thread-{}'.format(ident)))
+            stacks[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+class Profiler(object):
+    """Stage timings of all connections and profiles on demand"""
+
+    def __init__(self, directory='.', duration=10, interval=0.005):
+        self.directory = directory
+        self.duration = duration
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.finished = dict((d, Stages()) for d in DIRECTIONS)
+        self.connections = 0
+        self.live = {}
+        self.sampling = False
+
+    def session(self, client_address):
+        stages = dict((d, Stages()) for d in DIRECTIONS)
+        with self.lock:
+            self.live[_address(client_address)] = stages
+        return stages
+
+    def release(self, client_address):
+        with self.lock:
+            stages = self.live.pop(_address(client_address), None)
+            if stages is None:
+                return
+            self.connections += 1
+            for d in DIRECTIONS:
+                self.finished[d].merge(stages[d])
+
+    def totals(self):
+        totals = dict((d, Stages()) for d in DIRECTIONS)
+        with self.lock:
+            sessions = list(self.live.values())
+            for d in DIRECTIONS:
+                totals[d].merge(self.finished[d])
+        for stages in sessions:
+            for d in DIRECTIONS:
+                totals[d].merge(stages[d])
+        return totals
+
+    def to_dict(self):
+        totals = self.totals()
+        with self.lock:
+            live = list(self.live.items())
+        return {
+            'connections': self.connections,
+            'live': len(live),
+            'stages': dict((d, totals[d].to_dict()) for d in DIRECTIONS),
+            'sessions': dict((address, dict((d, stages[d].to_dict()) for d in DIRECTIONS))
+                             for address, stages in live),
+        }
+
+    def _path(self, prefix, ext):
+        import datetime
+        name = '{}-{}.{}'.format(prefix, datetime.datetime.today().strftime('%Y%m%d-%H%M%S'), ext)
+        return os.path.join(self.directory, name)
+
+    def write_stages(self):
+        import json
+        result = self.to_dict()
+        path = self._path('stages', 'json')
+        with open(path, 'w') as fp:
+            json.dump(result, fp, indent=2, sort_keys=True)
+            fp.write('\n')
+        log.info('Wrote stage timings of %d connections to %s',
+                 result['connections'] + result['live'], path)
+        return path
+
+    def write_profile(self):
+        stacks = sample_stacks(self.duration, self.interval)
+        path = self._path('profile', 'folded')
+        with open(path, 'w') as fp:
+            for stack, count in stacks.most_common():
+                fp.write('{} {}\n'.format(stack, count))
+        log.info('Wrote profile to %s', path)
+        return path
+
+    def start_profile(self):
+        """Samples the stacks in a background thread"""
+        with self.lock:
+            if self.sampling:
+                return
+            self.sampling = True
+
+        def run():
+            try:
+                self.write_profile()
+            except (IOError, OSError) as e:
+                log.error('Could not write profile: %s', e)
+            finally:
+                self.sampling = False
+
+        t = threading.Thread(target=run, name='profiler')
+        t.daemon = True
+        t.start()
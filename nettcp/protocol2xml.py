@@ -11,19 +11,45 @@ from collections import defaultdict
 from wcf.records import Record, print_records
 from wcf.datatypes import MultiByteInt31, Utf8String
 from wcf.dictionary import dictionary
-from .nmf import Record as NMFRecord, register_types
+from .nmf import Record as NMFRecord
 
-try:
-    import pygments
-    import pygments.lexers
-    import pygments.formatters
-except ImportError:
-    warnings.warn('Pygments not found, no syntax highlighting available')
-    pygments = None
-
-
-old_dictionary = dictionary.copy()
 dictionary_cache = defaultdict(dict)
+# previous values of the wcf dictionary entries replaced by session strings
+_replaced = {}
+_MISSING = object()
+
+_highlight = None
+
+
+def get_highlight():
+    """Returns a function highlighting XML or False without pygments"""
+    global _highlight
+    if _highlight is None:
+        try:
+            import pygments
+            import pygments.lexers
+            import pygments.formatters
+        except ImportError:
+            warnings.warn('Pygments not found, no syntax highlighting available')
+            _highlight = False
+        else:
+            lexer = pygments.lexers.get_lexer_by_name('XML')
+            formatter = pygments.formatters.get_formatter_by_name('terminal')
+            _highlight = lambda code: pygments.highlight(code, lexer, formatter)
+    return _highlight
+
+
+def use_session_dictionary(strings):
+    """Puts the session strings into the wcf dictionary instead of the last ones"""
+    for idx, value in _replaced.items():
+        if value is _MISSING:
+            dictionary.pop(idx, None)
+        else:
+            dictionary[idx] = value
+    _replaced.clear()
+    for idx, value in strings.items():
+        _replaced[idx] = dictionary.get(idx, _MISSING)
+        dictionary[idx] = value
 
 
 def build_dictionary(fp, key):
@@ -38,9 +64,7 @@ def build_dictionary(fp, key):
         assert idx not in dictionary_cache[key]
         dictionary_cache[key][idx] = string.value
         idx += 2
-    dictionary.clear()
-    dictionary.update(old_dictionary)
-    dictionary.update(dictionary_cache[key])
+    use_session_dictionary(dictionary_cache[key])
 
     for idx, value in dictionary_cache[key].items():
         print('{}: {}'.format(idx, value))
@@ -55,10 +79,9 @@ def parse(data, key):
     print_records(records, fp=out)
     out.seek(0)
 
-    if pygments is not None:
-        print(pygments.highlight(out.read(),
-                                 pygments.lexers.get_lexer_by_name('XML'),
-                                 pygments.formatters.get_formatter_by_name('terminal')))
+    highlight = get_highlight()
+    if highlight:
+        print(highlight(out.read()))
     else:
         print(out.read())
 
@@ -70,7 +93,6 @@ def main():
     parser.add_argument('TRACE_FILE', type=argparse.FileType('r'))
 
     args = parser.parse_args()
-    register_types()
 
     with args.TRACE_FILE as fp:
         for line in fp:
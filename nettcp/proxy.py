@@ -3,49 +3,48 @@
 # Copyright 2016 Timo Schmid
 from __future__ import print_function, unicode_literals, absolute_import
 import socket
+import signal
 import logging
 import sys
-import binascii
 import threading
-import warnings
-import datetime
+import time
 
 try:
     import SocketServer
 except ImportError:
     import socketserver as SocketServer
 
-from .stream.socket import SocketStream
-from .nmf import (Record, EndRecord, KnownEncodingRecord,
-                  UpgradeRequestRecord, UpgradeResponseRecord, register_types)
-try:
-    from .stream.gssapi import GSSAPIStream
-except (ImportError, OSError):
-    warnings.warn('gssapi not installed, no negotiate protocol available')
-    GSSAPIStream = None
+from .stream.socket import SocketStream, ConnectionClosed, BufferLimitExceeded
+from .stream.framing import upgrade_request
+from .nmf import (Record, EndRecord, KnownEncodingRecord, FaultRecord,
+                  SizedEnvelopedMessageRecord, UnsizedEnvelopedMessageRecord,
+                  UpgradeResponseRecord)
+from .hexdump import get_print_hexdump
+from .profiling import clock
 
-try:
-    from helperlib import print_hexdump
-except ImportError:
-    warnings.warn('python-helperlib not installed, no hexdump available (https://github.com/bluec0re/python-helperlib)')
-    print_hexdump = False
 
-
-logging.basicConfig(level='DEBUG')
 log = logging.getLogger(__name__ + '.NETTCPProxy')
 
-trace_file = None
 
 
 def print_data(msg, data):
     if log.isEnabledFor(logging.DEBUG):
         print(msg, file=sys.stderr)
+        print_hexdump = get_print_hexdump()
         if print_hexdump:
             print_hexdump(data, colored=True, file=sys.stderr)
         else:
             print(data, file=sys.stderr)
 
 
+SERVER_TOO_BUSY = 'http://schemas.microsoft.com/ws/2006/05/framing/faults/ServerTooBusy'
+ENVELOPES = (SizedEnvelopedMessageRecord.code, UnsizedEnvelopedMessageRecord.code)
+
+
+class IdleTimeout(socket.timeout):
+    pass
+
+
 class RecvThread(threading.Thread):
     def __init__(self, handler):
         self.stop = threading.Event()
@@ -54,26 +53,84 @@ class RecvThread(threading.Thread):
         self.close_after_next_packet = False
 
     def run(self):
+        try:
+            self.forward()
+        except ConnectionClosed:
+            if not self.stop.is_set() and not self.handler.closed:
+                log.info('Server closed connection')
+                self.handler.half_close(self.handler.request)
+        except (socket.timeout, BufferLimitExceeded, socket.error) as e:
+            self.handler.abort(e)
+
+    def forward(self):
         log.debug('Handling data coming from the server')
-        while not self.stop.is_set():
-            obj = Record.parse_stream(self.handler.stream)
+        # runs until the server's EndRecord was forwarded, terminate() only
+        # tells that the client already ended, close() interrupts the read
+        stages = self.handler.direction_stages('s>c')
+        while True:
+            self.handler.wait_for_record(self.handler.stream)
+            obj = self.handler.read_record(self.handler.stream, stages)
+            self.handler.last_activity = time.time()
             log.debug('Got from server: %r', obj)
-            data = obj.to_bytes()
-
-            self.handler.log_data('s>c', data)
-
-            print_data('Got Data from server:', data)
-            self.handler.request.sendall(data)
-
-            if obj.code == EndRecord.code:
-                self.handler.stop.set()
-                if self.stop.is_set():
-                    log.info('Server confirmed end')
-                    self.handler.stream.close()
-                    self.handler.request.close()
-                else:
-                    log.info('Server requested end')
-                    self.stop.wait()
+            if self.handler.session_stats is not None:
+                self.handler.session_stats.record('s>c', obj, self.handler.last_activity)
+                if stages is not None:
+                    stages.lap('stats')
+
+            if obj.code == EndRecord.code and self.handler.ending:
+                log.info('Server confirmed end of drained session')
+                break
+
+            if self.handler.hooks is None:
+                records = (obj,)
+            else:
+                records = self.handler.hooks.apply('s>c', obj, self.handler)
+                if stages is not None:
+                    stages.lap('hooks')
+            for rec in records:
+                if self.server_record(rec, stages):
+                    return
+
+    def server_record(self, obj, stages=None):
+        """Forwards a record to the client, returns True if the session ended"""
+        if self.handler.cache_session is not None:
+            self.handler.cache_session.response(obj)
+            if stages is not None:
+                stages.lap('cache')
+
+        data = obj.to_bytes()
+        if stages is not None:
+            stages.lap('encode')
+
+        self.handler.log_data('s>c', data)
+        if stages is not None:
+            stages.lap('trace')
+
+        print_data('Got Data from server:', data)
+        if stages is not None:
+            stages.lap('log')
+        if self.handler.in_flight is None:
+            self.handler.write_client(data)
+        elif not self.handler.forward('s>c', obj, data, stages):
+            return False
+        if stages is not None:
+            # send was timed by the stream
+            stages.mark()
+
+        if obj.code in ENVELOPES:
+            self.handler.check_drained()
+        elif obj.code == EndRecord.code:
+            self.handler.stop.set()
+            if self.stop.is_set():
+                log.info('Server confirmed end')
+                self.handler.close()
+            else:
+                log.info('Server requested end')
+                if not self.stop.wait(self.handler.end_timeout):
+                    log.warning('Client %s:%d did not confirm end', *self.handler.client_address)
+                    self.handler.close()
+            return True
+        return False
 
     def terminate(self):
         self.stop.set()
@@ -82,78 +139,523 @@ class RecvThread(threading.Thread):
 class NETTCPProxy(SocketServer.BaseRequestHandler):
     negotiate = True
     server_name = None
+    # seconds a started read or write may stall, None blocks forever
+    read_timeout = None
+    write_timeout = None
+    # seconds without a record in either direction
+    idle_timeout = None
+    # seconds to wait for the peer to answer an EndRecord
+    end_timeout = 10
+    # largest record buffered for the client (c>s) and server (s>c) side
+    client_buffer = None
+    server_buffer = None
+    # ActionStats shared by all connections
+    stats = None
+    # compiled nettcp.hooks.Hooks
+    hooks = None
+    # ResponseCache shared by all connections
+    cache = None
+    # nettcp.trace.SharedTrace or ConnectionTraces
+    trace = None
+    # nettcp.profiling.Profiler collecting the stage timings
+    profiler = None
 
     def log_data(self, direction, data):
-        if trace_file is None:
+        if self.trace_session is None:
             return
 
-        args = self.client_address + (direction, binascii.b2a_hex(data).decode())
-        trace_file.write('{}\t{}:{}\t{}\t{}\n'.format(datetime.datetime.today(), *args))
-        trace_file.flush()
+        self.trace_session.write(direction, data)
 
     def handle(self):
         log.info('New connection from %s:%d', *self.client_address)
         self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.client_lock = threading.Lock()
+        self.server_lock = threading.Lock()
+        self.closed = False
+        # requests in flight, tracked once the session can be drained
+        self.in_flight = None
+        self.draining = False
+        self.ending = False
+        self.server_socket = None
+        self.recv_thread = None
+        self.last_activity = time.time()
+        self.session_stats = None
+        if self.stats is not None:
+            self.session_stats = self.stats.session()
+        self.cache_session = None
+        if self.cache is not None:
+            self.cache_session = self.cache.session()
+        self.trace_session = None
+        self.stages = None
+
+        connections = getattr(self.server, 'connections', None)
+        if connections is not None and not connections.attach(self.request, self):
+            log.info('Draining, dropping connection from %s:%d', *self.client_address)
+            return
+        if connections is not None:
+            from .stats import InFlight
+            self.in_flight = InFlight()
+
         s = socket.create_connection((TARGET_HOST, TARGET_PORT))
-        self.stream = SocketStream(s)
+        self.server_socket = s
+        if self.trace is not None:
+            self.trace_session = self.trace.session(self.client_address)
+        self.stream = SocketStream(s, self.read_timeout, self.write_timeout,
+                                   self.server_buffer)
+        self.request_stream = SocketStream(self.request, self.read_timeout,
+                                           self.write_timeout, self.client_buffer)
         self.negotiated = False
         t = RecvThread(self)
-        # t.daemon = True
+        t.daemon = True
+        self.recv_thread = t
+        if self.profiler is not None:
+            # released in the finally block below
+            self.stages = self.profiler.session(self.client_address)
+        self.time_stream(self.stream, 's>c', 'c>s')
+        self.time_stream(self.request_stream, 'c>s', 's>c')
 
         try:
             self.mainloop(s, t)
+        except ConnectionClosed:
+            if not self.closed:
+                log.info('Client closed connection')
+                self.half_close(s)
+                self.finish_server(t)
+        except (socket.timeout, BufferLimitExceeded, socket.error) as e:
+            self.abort(e)
         finally:
             t.terminate()
+            self.close()
+            if self.trace_session is not None:
+                if t.is_alive():
+                    # the server side may still be writing to the trace
+                    t.join(1)
+                self.trace_session.close()
+            if self.stages is not None:
+                self.profiler.release(self.client_address)
+
+    def finish_server(self, t):
+        """Lets the server send its responses after the client closed
+
+        Gives up once the server was silent for idle_timeout (or end_timeout)
+        seconds, a server ignoring the half-close would keep the thread.
+        """
+        timeout = self.end_timeout if self.idle_timeout is None else self.idle_timeout
+        while t.is_alive():
+            t.join(self.last_activity + timeout - time.time())
+            if t.is_alive() and time.time() - self.last_activity >= timeout:
+                log.warning('Server of %s:%d did not finish after the client closed',
+                            *self.client_address)
+                return
+
+    def direction_stages(self, direction):
+        if self.stages is None:
+            return None
+        return self.stages[direction]
+
+    def time_stream(self, stream, read_direction, write_direction):
+        if self.stages is not None:
+            stream.read_stages = self.stages[read_direction]
+            stream.write_stages = self.stages[write_direction]
+
+    def read_record(self, stream, stages):
+        if self.read_timeout is not None or stages is not None:
+            # read_timeout only starts with the record, waiting for it is
+            # idle time (and not recv)
+            stream.wait(None)
+        if stages is None:
+            return Record.parse_stream_lazy(stream)
+
+        io = stages.get('recv') + stages.get('decrypt')
+        start = clock()
+        obj = Record.parse_stream_lazy(stream)
+        stages.add('parse', clock() - start - (stages.get('recv') + stages.get('decrypt') - io))
+        stages.mark()
+        return obj
+
+    def write_client(self, data):
+        with self.client_lock:
+            self.request_stream.write(data)
+
+    def write_server(self, data):
+        with self.server_lock:
+            self.stream.write(data)
 
-    def mainloop(self, s, t):
-        request_stream = SocketStream(self.request)
-        while not self.stop.is_set():
-            obj = Record.parse_stream(request_stream)
-
-            log.debug('Client record: %s', obj)
+    def wait_for_record(self, stream):
+        if self.idle_timeout is None:
+            return
 
-            data = obj.to_bytes()
+        timeout = self.idle_timeout
+        while not stream.wait(timeout):
+            # the other direction may have been active in the meantime
+            timeout = self.last_activity + self.idle_timeout - time.time()
+            if timeout <= 0:
+                raise IdleTimeout('no traffic for {}s'.format(self.idle_timeout))
+
+    def forward(self, direction, obj, data, stages=None):
+        """Writes a record tracked in in_flight, returns False if it was dropped
+
+        The requests in flight are updated (before a reply can arrive) and the
+        record is written while holding the write lock of the peer, so the
+        session can neither end with a request just being forwarded nor send
+        its EndRecord before it. Once draining the client may not start calls.
+        """
+        headers = self.in_flight.scan(direction, obj)
+        if stages is not None:
+            stages.lap('stats')
+        if direction == 'c>s':
+            write_lock, stream = self.server_lock, self.stream
+        else:
+            write_lock, stream = self.client_lock, self.request_stream
+
+        with write_lock:
+            with self.lock:
+                drop = self.ending or (direction == 'c>s' and self.draining and
+                                       self.in_flight.is_request(headers))
+                if not drop:
+                    self.in_flight.update(direction, headers)
+            if not drop:
+                stream.write(data)
+        if drop:
+            log.warning('Session of %s:%d is %s, dropping %s record 0x%02x',
+                        self.client_address[0], self.client_address[1],
+                        'ending' if self.ending else 'draining', direction, obj.code)
+        return not drop
+
+    def check_drained(self):
+        with self.lock:
+            if self.ending or not self.draining or self.in_flight:
+                return
+            # decided together with the check, forward() drops what comes later
+            self.ending = True
+        self.end_session()
+
+    def drain(self):
+        """Ends the session with EndRecords once no request is in flight"""
+        with self.lock:
+            self.draining = True
+        self.check_drained()
+
+    def end_session(self):
+        if self.recv_thread is None or not self.recv_thread.is_alive():
+            # still in the preamble, nothing to finish
+            self.close()
+            return
 
-            self.log_data('c>s', data)
+        log.info('Ending session of %s:%d', *self.client_address)
+        end = EndRecord().to_bytes()
+        try:
+            self.write_server(end)
+            self.write_client(end)
+        except socket.error as e:
+            self.abort(e)
 
-            print_data('Got Data from client:', data)
+    def half_close(self, sock):
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+
+    def abort(self, reason):
+        if not self.closed:
+            log.warning('Closing connection from %s:%d: %s', *(self.client_address + (reason,)))
+        self.close()
+
+    def close(self):
+        self.closed = True
+        for sock in (self.server_socket, self.request):
+            if sock is None:
+                continue
+            try:
+                # wakes up the thread blocked on the other direction
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
 
-            self.stream.write(data)
+    def mainloop(self, s, t):
+        request_stream = self.request_stream
+        stages = self.direction_stages('c>s')
+        while not self.stop.is_set():
+            self.wait_for_record(request_stream)
+            obj = self.read_record(request_stream, stages)
+            self.last_activity = time.time()
 
-            if obj.code == KnownEncodingRecord.code:
-                if self.negotiate:
-                    upgr = UpgradeRequestRecord(UpgradeProtocolLength=21,
-                                                UpgradeProtocol='application/negotiate').to_bytes()
-                    s.sendall(upgr)
-                    resp = Record.parse_stream(SocketStream(s))
-                    assert resp.code == UpgradeResponseRecord.code, resp
-                    self.stream = GSSAPIStream(self.stream, self.server_name)
-                    self.stream.negotiate()
-                    self.negotiated = True
-                # start receive thread
-                t.start()
-            elif obj.code == EndRecord.code:
-                t.terminate()
-                if self.stop.is_set():
-                    log.info('Client confirmed end')
-                    s.close()
-                    self.request.close()
-                else:
-                    log.info('Client requested end')
-                    self.stop.wait()
+            log.debug('Client record: %s', obj)
+            if self.session_stats is not None:
+                self.session_stats.record('c>s', obj, self.last_activity)
+                if stages is not None:
+                    stages.lap('stats')
+
+            if obj.code == EndRecord.code and self.ending:
+                log.info('Client confirmed end of drained session')
+                break
+
+            if self.hooks is None:
+                records = (obj,)
+            else:
+                records = self.hooks.apply('c>s', obj, self)
+                if stages is not None:
+                    stages.lap('hooks')
+            for rec in records:
+                if self.client_record(rec, t, stages):
+                    return
+
+    def answer_from_cache(self, obj, response):
+        data = response.to_bytes()
+        self.log_data('c>s', obj.to_bytes())
+        self.log_data('s>c', data)
+        if self.session_stats is not None:
+            self.session_stats.record('s>c', response, time.time())
+        print_data('Answered from cache:', data)
+        self.write_client(data)
+
+    def client_record(self, obj, t, stages=None):
+        """Forwards a record to the server, returns True if the session ended"""
+        if self.cache_session is not None:
+            response = self.cache_session.request(obj)
+            if stages is not None:
+                stages.lap('cache')
+            if response is not None:
+                self.answer_from_cache(obj, response)
+                return False
+
+        data = obj.to_bytes()
+        if stages is not None:
+            stages.lap('encode')
+
+        self.log_data('c>s', data)
+        if stages is not None:
+            stages.lap('trace')
+
+        print_data('Got Data from client:', data)
+        if stages is not None:
+            stages.lap('log')
+
+        if self.in_flight is None:
+            self.write_server(data)
+        elif not self.forward('c>s', obj, data, stages):
+            return False
+        if stages is not None:
+            # send was timed by the stream
+            stages.mark()
+
+        if obj.code in ENVELOPES:
+            if self.in_flight is not None:
+                # the message may have answered a callback of the server
+                self.check_drained()
+        elif obj.code == KnownEncodingRecord.code:
+            if self.negotiate:
+                self.stream.write(upgrade_request())
+                resp = Record.parse_stream(self.stream)
+                assert resp.code == UpgradeResponseRecord.code, resp
+                from .stream.gssapi import GSSAPIStream
+                self.stream = GSSAPIStream(self.stream, self.server_name,
+                                           max_read=self.server_buffer)
+                self.stream.negotiate()
+                self.time_stream(self.stream, 's>c', 'c>s')
+                self.negotiated = True
+            # start receive thread
+            t.start()
+        elif obj.code == EndRecord.code:
+            t.terminate()
+            if self.stop.is_set():
+                log.info('Client confirmed end')
+            else:
+                log.info('Client requested end')
+                if not self.stop.wait(self.end_timeout):
+                    log.warning('Server did not confirm end of %s:%d', *self.client_address)
+            return True
+        return False
+
+
+class ConnectionRegistry(object):
+    def __init__(self, max_connections=None):
+        self.max_connections = max_connections
+        self.draining = False
+        self._connections = {}
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._connections)
+
+    def admit(self, request):
+        with self._cond:
+            if self.draining:
+                return False
+            if self.max_connections is not None and \
+                    len(self._connections) >= self.max_connections:
+                return False
+            self._connections[request] = None
+            return True
+
+    def attach(self, request, handler):
+        with self._cond:
+            if self.draining or request not in self._connections:
+                return False
+            self._connections[request] = handler
+            return True
+
+    def release(self, request):
+        with self._cond:
+            if self._connections.pop(request, False) is not False:
+                self._cond.notify_all()
+
+    def handlers(self):
+        with self._cond:
+            return [h for h in self._connections.values() if h is not None]
+
+    def wait_empty(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._connections:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+
+class NETTCPServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # the default backlog of 5 resets bursts of concurrent connects
+    request_queue_size = 128
+
+    def __init__(self, server_address, RequestHandlerClass=NETTCPProxy,
+                 max_connections=None):
+        SocketServer.ThreadingTCPServer.__init__(self, server_address, RequestHandlerClass)
+        self.connections = ConnectionRegistry(max_connections)
+        self._drain_thread = None
+
+    def verify_request(self, request, client_address):
+        if self.connections.admit(request):
+            return True
+
+        log.warning('Rejecting connection from %s:%d, %d connections active',
+                    *(client_address + (len(self.connections),)))
+        fault = FaultRecord(FaultSize=len(SERVER_TOO_BUSY), Fault=SERVER_TOO_BUSY)
+        try:
+            request.send(fault.to_bytes())
+        except socket.error:
+            pass
+        return False
+
+    def shutdown_request(self, request):
+        self.connections.release(request)
+        SocketServer.ThreadingTCPServer.shutdown_request(self, request)
+
+    def start_drain(self, timeout=None):
+        # shutdown() blocks until serve_forever returns, so it can't be
+        # called from a signal handler running in the serving thread
+        if self._drain_thread is None:
+            self._drain_thread = threading.Thread(target=self.drain, args=(timeout,))
+            self._drain_thread.daemon = True
+            self._drain_thread.start()
+
+    def drain(self, timeout=None):
+        log.info('Draining %d connections', len(self.connections))
+        self.connections.draining = True
+        self.shutdown()
+
+        for handler in self.connections.handlers():
+            handler.drain()
+
+        if not self.connections.wait_empty(timeout):
+            log.warning('Closing %d connections which did not finish in time',
+                        len(self.connections))
+            for handler in self.connections.handlers():
+                handler.close()
+            self.connections.wait_empty(1)
+
+    def wait_drained(self):
+        if self._drain_thread is not None:
+            self._drain_thread.join()
+
+
+def write_stats(path):
+    with open(path, 'w') as fp:
+        NETTCPProxy.stats.dump(fp)
+
+
+def write_stats_periodically(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            write_stats(path)
+        except (IOError, OSError) as e:
+            log.error('Could not write stats: %s', e)
 
 
 def main():
     import argparse
-    global trace_file, TARGET_HOST, TARGET_PORT
+    global TARGET_HOST, TARGET_PORT
+
+    logging.basicConfig(level='DEBUG')
 
     HOST, PORT = "localhost", 8090
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('-t', '--trace_file', type=argparse.FileType('w'))
+    trace = parser.add_mutually_exclusive_group()
+    trace.add_argument('-t', '--trace_file', metavar='FILE',
+                       help='Write all records to this trace file')
+    trace.add_argument('--trace-dir', metavar='DIR',
+                       help='Write the records of every connection to its own trace file')
+    parser.add_argument('--trace-max-bytes', type=int, metavar='BYTES',
+                        help='Rotate trace files larger than this')
+    parser.add_argument('--trace-max-age', type=float, metavar='SECONDS',
+                        help='Rotate trace files older than this')
+    parser.add_argument('--trace-backups', type=int, metavar='COUNT',
+                        help='Only keep this many rotated trace files (per connection)')
+    parser.add_argument('--trace-sample', type=float, metavar='PERCENT',
+                        help='Only trace this percentage of the connections')
+    parser.add_argument('--trace-records', type=int, metavar='COUNT',
+                        help='Only trace the first records of every connection')
+    parser.add_argument('--trace-session-bytes', type=int, metavar='BYTES',
+                        help='Only trace the first bytes of every connection')
+    parser.add_argument('--trace-via', metavar='PREFIX',
+                        help='Only trace connections to a Via starting with PREFIX')
     parser.add_argument('-b', '--bind', default=HOST)
     parser.add_argument('-p', '--port', type=int, default=PORT)
     parser.add_argument('-n', '--negotiate', help='Negotiate with the given server name')
+    parser.add_argument('--read-timeout', type=float, metavar='SECONDS',
+                        help='Abort connections stalling in the middle of a record')
+    parser.add_argument('--write-timeout', type=float, metavar='SECONDS',
+                        help='Abort connections whose peer does not accept data')
+    parser.add_argument('--idle-timeout', type=float, metavar='SECONDS',
+                        help='Close connections without traffic in either direction')
+    parser.add_argument('--end-timeout', type=float, default=NETTCPProxy.end_timeout,
+                        metavar='SECONDS',
+                        help='Wait this long for the peer to confirm an EndRecord or, '
+                             'without --idle-timeout, to finish after a half-close')
+    parser.add_argument('--max-connections', type=int,
+                        help='Reject connections beyond this number')
+    parser.add_argument('--drain-timeout', type=float, default=30, metavar='SECONDS',
+                        help='On SIGTERM, wait this long for in-flight calls before closing')
+    parser.add_argument('--stats', metavar='FILE',
+                        help='Write per SOAP action statistics as JSON to this file')
+    parser.add_argument('--stats-interval', type=float, default=60, metavar='SECONDS',
+                        help='Update the statistics file this often (default: 60)')
+    parser.add_argument('--client-buffer', type=int, metavar='BYTES',
+                        help='Largest record accepted from the client')
+    parser.add_argument('--server-buffer', type=int, metavar='BYTES',
+                        help='Largest record accepted from the server')
+    parser.add_argument('--hooks', metavar='MODULE',
+                        help='Intercept records with the hooks of a module or .py file')
+    parser.add_argument('--cache-action', action='append', metavar='ACTION',
+                        help='Answer repeated requests of this idempotent action from a cache')
+    parser.add_argument('--cache-ttl', type=float, default=60, metavar='SECONDS',
+                        help='Lifetime of cached responses (default: 60)')
+    parser.add_argument('--cache-size', type=int, default=16 * 1024 * 1024, metavar='BYTES',
+                        help='Memory used for cached responses (default: 16 MiB)')
+    parser.add_argument('--cache-entries', type=int,
+                        help='Maximal number of cached responses')
+    parser.add_argument('--profile-dir', metavar='DIR',
+                        help='Time the forwarding stages, SIGUSR1 writes the timings and '
+                             'SIGUSR2 a sampled profile to DIR')
+    parser.add_argument('--profile-duration', type=float, default=10, metavar='SECONDS',
+                        help='Sample the stacks this long on SIGUSR2 (default: 10)')
     parser.add_argument('TARGET_HOST')
     parser.add_argument('TARGET_PORT', type=int)
 
@@ -162,20 +664,76 @@ def main():
     TARGET_HOST = args.TARGET_HOST
     TARGET_PORT = args.TARGET_PORT
 
-    trace_file = args.trace_file
-
-    register_types()
-
     NETTCPProxy.negotiate = bool(args.negotiate)
     NETTCPProxy.server_name = args.negotiate
-
-    if GSSAPIStream is None and NETTCPProxy.negotiate:
-        log.error("GSSAPI not available, negotiation not possible. Try python2 with gssapi")
-        sys.exit(1)
-
-    server = SocketServer.ThreadingTCPServer((args.bind, args.port), NETTCPProxy)
+    NETTCPProxy.read_timeout = args.read_timeout
+    NETTCPProxy.write_timeout = args.write_timeout
+    NETTCPProxy.idle_timeout = args.idle_timeout
+    NETTCPProxy.end_timeout = args.end_timeout
+    NETTCPProxy.client_buffer = args.client_buffer
+    NETTCPProxy.server_buffer = args.server_buffer
+    trace_options = (args.trace_max_bytes, args.trace_max_age, args.trace_backups)
+    if args.trace_dir:
+        from .trace import ConnectionTraces
+        NETTCPProxy.trace = ConnectionTraces(args.trace_dir, *trace_options)
+    elif args.trace_file:
+        from .trace import SharedTrace
+        NETTCPProxy.trace = SharedTrace(args.trace_file, *trace_options)
+    sampling = (args.trace_sample, args.trace_records, args.trace_session_bytes, args.trace_via)
+    if NETTCPProxy.trace is not None and sampling != (None,) * len(sampling):
+        from .trace import SampledTrace
+        rate = None if args.trace_sample is None else args.trace_sample / 100.0
+        NETTCPProxy.trace = SampledTrace(NETTCPProxy.trace, rate, args.trace_records,
+                                         args.trace_session_bytes, args.trace_via)
+    if args.profile_dir:
+        from .profiling import Profiler
+        NETTCPProxy.profiler = Profiler(args.profile_dir, args.profile_duration)
+    if args.hooks:
+        from .hooks import load_hooks
+        NETTCPProxy.hooks = load_hooks(args.hooks)
+    if args.cache_action:
+        from .cache import ResponseCache
+        NETTCPProxy.cache = ResponseCache(args.cache_action, args.cache_ttl,
+                                          args.cache_size, args.cache_entries)
+    if args.stats:
+        from .stats import ActionStats
+        NETTCPProxy.stats = ActionStats()
+        t = threading.Thread(target=write_stats_periodically,
+                             args=(args.stats, args.stats_interval))
+        t.daemon = True
+        t.start()
+
+    if NETTCPProxy.negotiate:
+        try:
+            from .stream.gssapi import GSSAPIStream  # noqa: F401
+        except (ImportError, OSError):
+            log.error("GSSAPI not available, negotiation not possible. Try python2 with gssapi")
+            sys.exit(1)
+
+    server = NETTCPServer((args.bind, args.port), NETTCPProxy,
+                          max_connections=args.max_connections)
+
+    if hasattr(signal, 'SIGTERM'):
+        signal.signal(signal.SIGTERM,
+                      lambda signum, frame: server.start_drain(args.drain_timeout))
+    profiler = NETTCPProxy.profiler
+    if profiler is not None and hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.write_stages())
+        signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.start_profile())
 
     server.serve_forever()
+    server.wait_drained()
+    server.server_close()
+
+    if args.stats:
+        write_stats(args.stats)
+    if NETTCPProxy.trace is not None:
+        NETTCPProxy.trace.close()
+    if profiler is not None:
+        profiler.write_stages()
+    if NETTCPProxy.cache is not None:
+        log.info('Response cache: %d hits, %d misses',
+                 NETTCPProxy.cache.hits, NETTCPProxy.cache.misses)
 
 if __name__ == "__main__":
     main()
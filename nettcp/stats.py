@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+# Copyright 2016 Timo Schmid
+"""Per SOAP action statistics without decoding the full binary XML
+
+Only the WS-Addressing headers of a SizedEnvelopedMessageRecord payload are
+scanned ([MC-NBFX] records up to the end of the SOAP header), strings are
+resolved with the session dictionary ([MC-NBFSE]) sent at the start of every
+payload.
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import struct
+import binascii
+import threading
+from collections import deque
+
+from .trace import parse_line
+from .nmf import Record, SizedEnvelopedMessageRecord
+
+__all__ = [
+    'SessionDictionary',
+    'scan_headers',
+    'ActionStats',
+    'SessionStats',
+    'InFlight',
+]
+
+HEADERS = ('Action', 'To', 'MessageID', 'RelatesTo')
+
+# subset of the static [MC-NBFS] dictionary needed to find the headers
+STATIC_DICTIONARY = {
+    0x08: 'Header',
+    0x0A: 'Action',
+    0x0C: 'To',
+    0x0E: 'Body',
+    0x12: 'RelatesTo',
+    0x14: 'http://www.w3.org/2005/08/addressing/anonymous',
+    0x1A: 'MessageID',
+}
+
+# text records with a fixed size payload, the odd code ends the element
+FIXED_TEXT = {
+    0x80: 0, 0x82: 0, 0x84: 0, 0x86: 0, 0x88: 1, 0x8A: 2, 0x8C: 4, 0x8E: 8,
+    0x90: 4, 0x92: 8, 0x94: 16, 0x96: 8, 0xA4: 0, 0xA6: 0, 0xA8: 0, 0xAC: 16,
+    0xAE: 8, 0xB0: 16, 0xB2: 8, 0xB4: 1,
+}
+SIMPLE_TEXT = {0x80: '0', 0x82: '1', 0x84: 'false', 0x86: 'true', 0xA8: ''}
+# text records with a length prefix: (length format, encoding)
+SIZED_TEXT = {
+    0x98: ('<B', 'utf-8'), 0x9A: ('<H', 'utf-8'), 0x9C: ('<i', 'utf-8'),
+    0x9E: ('<B', None), 0xA0: ('<H', None), 0xA2: ('<i', None),
+    0xB6: ('<B', 'utf-16-le'), 0xB8: ('<H', 'utf-16-le'), 0xBA: ('<i', 'utf-16-le'),
+}
+
+
+class ScanError(ValueError):
+    pass
+
+
+SCAN_ERRORS = (ScanError, IndexError, struct.error, UnicodeDecodeError)
+
+
+def byte_view(data):
+    """Returns data indexable as integers, only Python 2 needs a copy"""
+    if isinstance(data, bytearray):
+        return data
+    if bytes is str:
+        return bytearray(data)
+    return memoryview(data)
+
+
+def mbi31(data, pos):
+    if not isinstance(data, (bytearray, memoryview)):
+        data = byte_view(data)
+    val = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ScanError('Truncated MultiByteInt31')
+        d = data[pos]
+        pos += 1
+        val |= (d & 0x7f) << shift
+        shift += 7
+        if not d & 0x80:
+            return val, pos
+
+
+def string(data, pos):
+    size, pos = mbi31(data, pos)
+    if pos + size > len(data):
+        raise ScanError('Truncated string')
+    return bytes(data[pos:pos + size]).decode('utf-8'), pos + size
+
+
+def static_string(idx):
+    try:
+        return STATIC_DICTIONARY[idx]
+    except KeyError:
+        pass
+    try:
+        from wcf.dictionary import dictionary
+        return dictionary[idx]
+    except (ImportError, KeyError):
+        return 'dict:{}'.format(idx)
+
+
+class SessionDictionary(object):
+    """Strings a peer added to its session dictionary, one per direction"""
+
+    def __init__(self):
+        self.strings = []
+
+    def update(self, payload):
+        """Adds the strings of the payload, returns the offset of the XML"""
+        data = byte_view(payload)
+        size, pos = mbi31(data, 0)
+        end = pos + size
+        while pos < end:
+            value, pos = string(data, pos)
+            self.strings.append(value)
+        return end
+
+    def lookup(self, idx):
+        if not idx & 1:
+            return static_string(idx)
+        try:
+            return self.strings[idx >> 1]
+        except IndexError:
+            return 'session:{}'.format(idx)
+
+
+def guid(raw):
+    """Formats a little endian GUID like uuid.UUID(bytes_le=raw)"""
+    raw = bytes(raw)
+    head = struct.unpack('<IHH', raw[:8])
+    tail = binascii.hexlify(raw[8:]).decode()
+    return '{:08x}-{:04x}-{:04x}-{}-{}'.format(head[0], head[1], head[2], tail[:4], tail[4:])
+
+
+def text(data, pos, dictionary):
+    """Parses a text record, returns (value, end element, new pos)"""
+    code = data[pos]
+    base = code & ~1
+    end_element = bool(code & 1)
+    pos += 1
+
+    if base == 0xAA:
+        idx, pos = mbi31(data, pos)
+        return dictionary.lookup(idx), end_element, pos
+    elif base == 0xBC:
+        # QNameDictionaryText: prefix a-z and a dictionary string
+        if pos >= len(data):
+            raise ScanError('Truncated QNameDictionaryText')
+        prefix = chr(ord('a') + data[pos])
+        idx, pos = mbi31(data, pos + 1)
+        return '{}:{}'.format(prefix, dictionary.lookup(idx)), end_element, pos
+    elif base in SIZED_TEXT:
+        fmt, encoding = SIZED_TEXT[base]
+        s = struct.calcsize(fmt)
+        size = struct.unpack(fmt, data[pos:pos + s])[0]
+        pos += s
+        value = bytes(data[pos:pos + size])
+        if encoding:
+            value = value.decode(encoding)
+        return value, end_element, pos + size
+    elif base in FIXED_TEXT:
+        size = FIXED_TEXT[base]
+        raw = data[pos:pos + size]
+        if base == 0xAC:
+            value = 'urn:uuid:{}'.format(guid(raw))
+        elif base == 0xB0:
+            value = guid(raw)
+        else:
+            value = SIMPLE_TEXT.get(base)
+        return value, end_element, pos + size
+
+    raise ScanError('Unsupported text record 0x{:02x}'.format(code))
+
+
+def scan_headers(payload, dictionary, names=HEADERS):
+    """Extracts the given addressing headers from a binary SOAP envelope
+
+    Returns a dict mapping header name to (value, start, end) where start
+    and end delimit the text record holding the value in the payload.
+    The payload is not copied, except on Python 2.
+    """
+    data = byte_view(payload)
+    pos = dictionary.update(data)
+    found = {}
+    stack = []
+    # a text record directly inside a wanted element starts here
+    current = None
+
+    while pos < len(data):
+        code = data[pos]
+        start = pos
+
+        if code == 0x01:
+            pos += 1
+            stack.pop()
+            if stack == ['Envelope']:
+                break
+            continue
+        elif 0x40 <= code <= 0x77:
+            pos += 1
+            if code == 0x40:
+                name, pos = string(data, pos)
+            elif code == 0x41:
+                _, pos = string(data, pos)
+                name, pos = string(data, pos)
+            elif code == 0x43:
+                _, pos = string(data, pos)
+                idx, pos = mbi31(data, pos)
+                name = dictionary.lookup(idx)
+            elif code == 0x42 or code <= 0x5D:
+                idx, pos = mbi31(data, pos)
+                name = dictionary.lookup(idx)
+            else:
+                name, pos = string(data, pos)
+
+            if name == 'Body':
+                break
+            stack.append(name)
+            current = name if name in names and len(stack) == 3 else None
+            continue
+        elif 0x04 <= code <= 0x3F:
+            pos += 1
+            if code in (0x05, 0x09):
+                _, pos = string(data, pos)
+                _, pos = string(data, pos)
+            elif code in (0x04, 0x08) or code >= 0x26:
+                _, pos = string(data, pos)
+            elif code == 0x07 or code == 0x0B:
+                _, pos = string(data, pos)
+                _, pos = mbi31(data, pos)
+            else:
+                _, pos = mbi31(data, pos)
+            if code not in (0x08, 0x09, 0x0A, 0x0B):
+                # attribute value
+                _, _, pos = text(data, pos, dictionary)
+            continue
+        elif 0x80 <= code <= 0xBD:
+            value, end_element, pos = text(data, pos, dictionary)
+            if current is not None and current not in found:
+                found[current] = (value, start, pos)
+            if end_element:
+                stack.pop()
+            current = None
+            continue
+
+        # comments, arrays and unknown records are not expected in headers
+        break
+
+    return found
+
+
+class ActionStats(object):
+    """Count, bytes, latency and To addresses per action, shared by all sessions"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.actions = {}
+
+    def _entry(self, action):
+        entry = self.actions.get(action)
+        if entry is None:
+            entry = self.actions[action] = {
+                'count': 0,
+                'bytes': 0,
+                'latency_count': 0,
+                'latency_total': 0.0,
+                'latency_max': 0.0,
+                'to': {},
+            }
+        return entry
+
+    def add(self, action, size, to=None):
+        with self.lock:
+            entry = self._entry(action)
+            entry['count'] += 1
+            entry['bytes'] += size
+            if to is not None:
+                entry['to'][to] = entry['to'].get(to, 0) + 1
+
+    def add_latency(self, action, latency):
+        with self.lock:
+            entry = self._entry(action)
+            entry['latency_count'] += 1
+            entry['latency_total'] += latency
+            entry['latency_max'] = max(entry['latency_max'], latency)
+
+    def to_dict(self):
+        with self.lock:
+            result = {}
+            for action, entry in self.actions.items():
+                entry = dict(entry)
+                entry['to'] = dict(entry['to'])
+                if entry['latency_count']:
+                    entry['latency_mean'] = entry['latency_total'] / entry['latency_count']
+                result[action] = entry
+            return result
+
+    def session(self):
+        return SessionStats(self)
+
+    def dump(self, fp):
+        import json
+        json.dump(self.to_dict(), fp, indent=2, sort_keys=True)
+        fp.write('\n')
+
+    def print_table(self, file=None):
+        rows = sorted(self.to_dict().items(), key=lambda i: -i[1]['bytes'])
+        print('{:>8} {:>12} {:>10} {:>10}  {}'.format(
+            'count', 'bytes', 'mean ms', 'max ms', 'action (to)'), file=file)
+        for action, entry in rows:
+            mean = entry.get('latency_mean')
+            print('{:>8} {:>12} {:>10} {:>10}  {}{}'.format(
+                entry['count'], entry['bytes'],
+                '-' if mean is None else '{:.3f}'.format(mean * 1000),
+                '-' if mean is None else '{:.3f}'.format(entry['latency_max'] * 1000),
+                action, _format_to(entry['to'])), file=file)
+
+
+def _format_to(to):
+    """The most frequent To address and how many others there are"""
+    if not to:
+        return ''
+    address = max(to, key=lambda a: to[a])
+    others = len(to) - 1
+    return ' ({}{})'.format(address, ' +{}'.format(others) if others else '')
+
+
+class SessionStats(object):
+    """Tracks the dictionaries and open requests of a single connection"""
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.dictionaries = {'c>s': SessionDictionary(), 's>c': SessionDictionary()}
+        self.pending = {}
+        self.unrelated = deque()
+
+    def record(self, direction, obj, timestamp):
+        if obj.code != SizedEnvelopedMessageRecord.code:
+            return
+
+        try:
+            headers = scan_headers(obj.field_bytes('Payload'), self.dictionaries[direction])
+        except SCAN_ERRORS:
+            headers = {}
+
+        action = headers.get('Action', ('?',))[0]
+        self.stats.add(action, obj.Size, headers.get('To', (None,))[0])
+
+        if direction == 'c>s':
+            message_id = headers.get('MessageID', (None,))[0]
+            if message_id is None:
+                self.unrelated.append((action, timestamp))
+            else:
+                self.pending[message_id] = (action, timestamp)
+            return
+
+        relates_to = headers.get('RelatesTo', (None,))[0]
+        request = self.pending.pop(relates_to, None)
+        if request is None and self.unrelated:
+            request = self.unrelated.popleft()
+        if request is not None:
+            self.stats.add_latency(request[0], timestamp - request[1])
+
+
+class InFlight(object):
+    """Requests of a connection which were not answered yet
+
+    Only messages with a MessageID expect a reply, one-way messages are not
+    counted. Both peers may send requests (duplex callbacks), a reply is
+    matched by its RelatesTo with the requests of the other peer.
+    """
+
+    def __init__(self):
+        self.dictionaries = {'c>s': SessionDictionary(), 's>c': SessionDictionary()}
+        self.lock = threading.Lock()
+        self.pending = set()
+
+    def scan(self, direction, obj):
+        """Returns MessageID and RelatesTo of an envelope as for scan_headers"""
+        if obj.code != SizedEnvelopedMessageRecord.code:
+            return {}
+
+        try:
+            return scan_headers(obj.field_bytes('Payload'), self.dictionaries[direction],
+                                ('MessageID', 'RelatesTo'))
+        except SCAN_ERRORS:
+            return {}
+
+    @staticmethod
+    def is_request(headers):
+        return 'MessageID' in headers and 'RelatesTo' not in headers
+
+    def update(self, direction, headers):
+        """Adds a request or removes the request answered by the scanned message"""
+        with self.lock:
+            if 'RelatesTo' in headers:
+                other = 's>c' if direction == 'c>s' else 'c>s'
+                self.pending.discard((other, headers['RelatesTo'][0]))
+            elif 'MessageID' in headers:
+                self.pending.add((direction, headers['MessageID'][0]))
+
+    def message(self, direction, obj):
+        """Adds a request or removes the request answered by obj"""
+        self.update(direction, self.scan(direction, obj))
+
+    def __len__(self):
+        return len(self.pending)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Aggregate SOAP actions of a trace')
+    parser.add_argument('TRACE_FILE', type=argparse.FileType('r'))
+    parser.add_argument('-j', '--json', action='store_true', help='Output JSON')
+
+    args = parser.parse_args()
+
+    stats = ActionStats()
+    sessions = {}
+    with args.TRACE_FILE as fp:
+        for line in fp:
+            timestamp, connection, dir, data = parse_line(line)
+
+            session = sessions.get(connection)
+            if session is None:
+                session = sessions[connection] = SessionStats(stats)
+
+            while data:
+                s, obj = Record.parse(data)
+                data = data[s:]
+                session.record(dir, obj, timestamp or 0)
+
+    if args.json:
+        import sys
+        stats.dump(sys.stdout)
+    else:
+        stats.print_table()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+"""Layered streams: socket, NNS framing, GSSAPI wrap and NMF envelopes
+
+Every layer wraps the one below and has the same methods:
+
+    read(count=None)    exactly count bytes or, without count, the next
+                        message of the layer (whatever the socket returned,
+                        a NNS payload, a decrypted message, a SOAP payload);
+                        bytes left over by read(count) come first
+    write(data)
+    wait(timeout=None)  True if read() won't block (blocking streams only)
+    close()
+
+A socket closed by the peer raises ConnectionClosed. After the EndRecord of
+the peer the NMF layer returns None from read() and raises ConnectionClosed
+from read(count).
+
+The blocking streams are used by the threaded proxy and the client, the
+asyncio streams in nettcp.stream.aio have the same methods as coroutines.
+Both share the framing code in nettcp.stream.framing, NNSFramer and
+GSSAPIContext.
+"""
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+# Copyright 2016 Timo Schmid
+"""asyncio versions of the streams (Python 3.5+)
+
+The layers are the same as for the blocking streams and use the same framing
+code, read, write and close are coroutines. There is no wait(), use
+asyncio.wait_for() around read() instead.
+
+    stream = await open_nmf_stream('127.0.0.1', 8000, 'net.tcp://127.0.0.1/Service1')
+    await stream.write(payload)
+    response = await stream.read()
+    await stream.close()
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import socket
+import asyncio
+
+from ..nmf import PreambleEndRecord, PreambleAckRecord, UpgradeResponseRecord, EndRecord
+from .socket import ConnectionClosed, BufferLimitExceeded, dump
+from .negotiate import NNSFramer
+from .framing import (MessageBuffer, RecordReader, preamble, upgrade_request, expect,
+                      envelope, message_payload)
+
+__all__ = [
+    'AsyncSocketStream',
+    'AsyncNegotiateStream',
+    'AsyncGSSAPIStream',
+    'AsyncNMFStream',
+    'open_nmf_stream',
+]
+
+
+async def _timeout(coro, timeout, message):
+    if timeout is None:
+        return await coro
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        raise socket.timeout(message)
+
+
+class AsyncSocketStream(object):
+    def __init__(self, reader, writer, read_timeout=None, write_timeout=None, max_read=None):
+        self._reader = reader
+        self._writer = writer
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.max_read = max_read
+
+    async def read(self, count=None):
+        if count is None:
+            data = await _timeout(self._reader.read(4096), self.read_timeout, 'read timed out')
+            if not data:
+                raise ConnectionClosed('Connection closed by peer')
+        else:
+            if self.max_read is not None and count > self.max_read:
+                raise BufferLimitExceeded('Refusing to buffer {} bytes (limit {})'.format(
+                    count, self.max_read))
+            try:
+                data = await _timeout(self._reader.readexactly(count), self.read_timeout,
+                                      'read timed out')
+            except asyncio.IncompleteReadError:
+                raise ConnectionClosed('Connection closed by peer')
+
+        dump('Recved Data:', data)
+        return data
+
+    async def write(self, data):
+        dump('Sent Data:', data)
+        self._writer.write(data)
+        await _timeout(self._writer.drain(), self.write_timeout, 'write timed out')
+
+    async def close(self):
+        self._writer.close()
+        if hasattr(self._writer, 'wait_closed'):
+            try:
+                await self._writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+
+class AsyncMessageReader(object):
+    """read() of a layer receiving whole messages, see MessageReader"""
+    max_read = None
+
+    async def read(self, count=None):
+        if count is None:
+            if self._readcache:
+                return self._readcache.take()
+            return await self._next_message()
+
+        if self.max_read is not None and count > self.max_read:
+            raise BufferLimitExceeded('Refusing to buffer {} bytes (limit {})'.format(
+                count, self.max_read))
+
+        while len(self._readcache) < count:
+            data = await self._next_message()
+            if data is None:
+                raise ConnectionClosed('Session ended')
+            self._readcache.feed(data)
+        return self._readcache.take(count)
+
+
+class AsyncNegotiateStream(AsyncMessageReader):
+    def __init__(self, stream):
+        self._inner = stream
+        self._framer = NNSFramer()
+        self._readcache = MessageBuffer()
+
+    async def write(self, data):
+        await self._inner.write(self._framer.encode(data))
+
+    async def _next_message(self):
+        size = self._framer.parse_header(await self._inner.read(self._framer.header_size()))
+        return self._framer.parse_payload(await self._inner.read(size) if size else b'')
+
+    async def close(self):
+        await self._inner.close()
+
+
+class AsyncGSSAPIStream(AsyncMessageReader):
+    def __init__(self, stream, server_name, flags=None, max_read=None):
+        from .gssapi import GSSAPIContext, DEFAULT_FLAGS
+        self.context = GSSAPIContext(server_name, DEFAULT_FLAGS if flags is None else flags)
+        self._inner = AsyncNegotiateStream(stream)
+        self._readcache = MessageBuffer()
+        self.max_read = max_read
+
+    async def negotiate(self):
+        await self._inner.write(self.context.step())
+        while not self.context.complete:
+            await self._inner.write(self.context.step(await self._inner.read()))
+
+    async def write(self, data):
+        if not self.context.client_ctx:
+            await self.negotiate()
+
+        for e_data in self.context.wrap(data):
+            await self._inner.write(e_data)
+
+    async def read(self, count=None):
+        if not self.context.client_ctx:
+            await self.negotiate()
+        return await AsyncMessageReader.read(self, count)
+
+    async def _next_message(self):
+        return self.context.decrypt(await self._inner.read())
+
+    async def close(self):
+        await self._inner.close()
+
+
+class AsyncNMFStream(AsyncMessageReader):
+    def __init__(self, stream, url, server_name=None, max_buffer=None):
+        self._inner = stream
+        self._server_name = server_name
+        self._records = RecordReader(max_buffer)
+        self._readcache = MessageBuffer()
+        self.url = url
+
+    async def preamble(self):
+        await self._inner.write(preamble(self.url))
+
+        if self._server_name:
+            await self._inner.write(upgrade_request())
+            expect(await self._inner.read(1), UpgradeResponseRecord, 'Negotiate not supported')
+
+            self._inner = AsyncGSSAPIStream(self._inner, self._server_name)
+
+        await self._inner.write(PreambleEndRecord().to_bytes())
+
+        expect(await self._inner.read(1), PreambleAckRecord, 'Preamble end not acked')
+
+    async def write(self, data):
+        await self._inner.write(envelope(data))
+
+    async def read_record(self):
+        """Returns the next record as (bytes, record)"""
+        result = self._records.read()
+        while result is None:
+            self._records.feed(await self._inner.read())
+            result = self._records.read()
+        return result
+
+    async def _next_message(self):
+        """Returns the payload of the next message or None at the end"""
+        return message_payload((await self.read_record())[1])
+
+    async def close(self):
+        await self._inner.write(EndRecord().to_bytes())
+        await self._inner.close()
+
+
+async def open_nmf_stream(host, port, url, server_name=None, **kwargs):
+    """Connects and sends the preamble, kwargs are passed to AsyncSocketStream"""
+    reader, writer = await asyncio.open_connection(host, port)
+    sock = writer.get_extra_info('socket')
+    if sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    stream = AsyncNMFStream(AsyncSocketStream(reader, writer, **kwargs), url, server_name)
+    await stream.preamble()
+    return stream
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+# Copyright 2016 Timo Schmid
+"""NMF framing without any I/O
+
+Shared by the blocking streams, their asyncio counterparts in
+nettcp.stream.aio and the pcap reader, which only differ in how the bytes
+are read and written.
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+from .socket import ConnectionClosed, BufferLimitExceeded
+from ..nmf import (Record, VersionRecord, ModeRecord, ViaRecord,
+                   KnownEncodingRecord, UpgradeRequestRecord,
+                   SizedEnvelopedMessageRecord, UnsizedEnvelopedMessageRecord, EndRecord,
+                   FaultRecord)
+
+__all__ = [
+    'chunks',
+    'MessageBuffer',
+    'MessageReader',
+    'next_record',
+    'RecordReader',
+    'preamble',
+    'upgrade_request',
+    'expect',
+    'envelope',
+    'message_payload',
+]
+
+def chunks(data, size):
+    """Splits data into parts of at most size bytes"""
+    if not data:
+        return []
+    if len(data) <= size:
+        return [data]
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class MessageBuffer(object):
+    """Bytes of received messages which were not read yet"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+
+    def take(self, count=None):
+        """Returns count bytes (default: everything), None if there are less"""
+        if count is None:
+            count = len(self.buffer)
+        elif count > len(self.buffer):
+            return None
+        data = bytes(self.buffer[:count])
+        del self.buffer[:count]
+        return data
+
+    def __len__(self):
+        return len(self.buffer)
+
+
+class _ExactReader(object):
+    """Reads from a buffer, a short read means the record is incomplete"""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, count):
+        end = self.pos + count
+        if end > len(self.data):
+            raise EOFError
+        data = bytes(self.data[self.pos:end])
+        self.pos = end
+        return data
+
+
+class MessageReader(object):
+    """read() and wait() of a layer receiving whole messages
+
+    read() returns the next message, read(count) exactly count bytes of the
+    messages. Subclasses set _inner and _readcache (a MessageBuffer) and
+    implement _next_message(), which returns None at the end of the session.
+    """
+    # largest single read, the inner stream only sees the messages
+    max_read = None
+
+    def wait(self, timeout=None):
+        if self._readcache:
+            return True
+        return self._inner.wait(timeout)
+
+    def read(self, count=None):
+        if count is None:
+            if self._readcache:
+                return self._readcache.take()
+            return self._next_message()
+
+        if self.max_read is not None and count > self.max_read:
+            raise BufferLimitExceeded('Refusing to buffer {} bytes (limit {})'.format(
+                count, self.max_read))
+
+        while len(self._readcache) < count:
+            data = self._next_message()
+            if data is None:
+                raise ConnectionClosed('Session ended')
+            self._readcache.feed(data)
+        return self._readcache.take(count)
+
+
+def _varint_complete(buffer, pos):
+    """Returns (length, value) of the varint at pos or None if it is cut"""
+    value = 0
+    for i in range(5):
+        if pos + i >= len(buffer):
+            return None
+        value |= (buffer[pos + i] & 0x7f) << (7 * i)
+        if not buffer[pos + i] & 0x80:
+            break
+    return i + 1, value
+
+
+def _chunks_end(buffer, pos=1):
+    """Scans the data chunks of an unsized envelope from pos
+
+    Returns the end of the record (None if it is incomplete) and the start of
+    the first chunk which is not complete yet.
+    """
+    while True:
+        header = _varint_complete(buffer, pos)
+        if header is None:
+            return None, pos
+        skip, size = header
+        if not size:
+            return pos + skip, pos
+        if len(buffer) < pos + skip + size:
+            return None, pos
+        pos += skip + size
+
+
+def next_record(buffer, end=None):
+    """Returns the raw bytes and the (lazy) record at the start of buffer
+
+    Returns None if the record is incomplete, raises KeyError for unknown
+    record types. end is the end of an unsized envelope if its chunks were
+    already scanned.
+    """
+    if not buffer:
+        return None
+    if buffer[0] == SizedEnvelopedMessageRecord.code:
+        # avoid parsing partial payloads over and over again
+        header = _varint_complete(buffer, 1)
+        if header is None or len(buffer) < 1 + header[0] + header[1]:
+            return None
+    elif buffer[0] == UnsizedEnvelopedMessageRecord.code and end is None:
+        end = _chunks_end(buffer)[0]
+        if end is None:
+            return None
+    # Record.parse reads missing varints as 0 and would accept a record cut
+    # after its code byte
+    try:
+        obj = Record.parse_stream_lazy(_ExactReader(buffer))
+    except EOFError:
+        return None
+    return obj.to_bytes(), obj
+
+
+class RecordReader(MessageBuffer):
+    """Splits received bytes into records"""
+
+    def __init__(self, max_buffer=None):
+        MessageBuffer.__init__(self)
+        self.max_buffer = max_buffer
+        # chunks of an unsized envelope already scanned, so that every
+        # received part only scans the new chunks
+        self._chunks = 1
+        # record parsed by complete() but not read yet
+        self._complete = None
+
+    def feed(self, data):
+        MessageBuffer.feed(self, data)
+        if self.max_buffer is not None and len(self.buffer) > self.max_buffer:
+            raise IOError('Record exceeds buffer limit of {} bytes'.format(self.max_buffer))
+
+    def complete(self):
+        """True if a whole record was received"""
+        if self._complete is None:
+            self._complete = self.read()
+        return self._complete is not None
+
+    def read(self):
+        """Returns the next record as (bytes, record) or None"""
+        if self._complete is not None:
+            result, self._complete = self._complete, None
+            return result
+        end = None
+        if self.buffer and self.buffer[0] == UnsizedEnvelopedMessageRecord.code:
+            end, self._chunks = _chunks_end(self.buffer, self._chunks)
+            if end is None:
+                return None
+        try:
+            result = next_record(self.buffer, end)
+        except KeyError:
+            raise IOError('Unknown record 0x{:02x}'.format(self.buffer[0]))
+        if result is not None:
+            del self.buffer[:len(result[0])]
+            self._chunks = 1
+        return result
+
+
+def preamble(url):
+    return b''.join(d.to_bytes() for d in [
+        VersionRecord(MajorVersion=1, MinorVersion=0),
+        ModeRecord(Mode=2),
+        ViaRecord(ViaLength=len(url), Via=url),
+        KnownEncodingRecord(Encoding=8),
+    ])
+
+
+def upgrade_request():
+    return UpgradeRequestRecord(UpgradeProtocolLength=21,
+                                UpgradeProtocol='application/negotiate').to_bytes()
+
+
+def expect(data, record_type, error):
+    """Raises IOError(error) unless data is the record without fields"""
+    if data != record_type().to_bytes():
+        raise IOError(error)
+
+
+def envelope(payload):
+    return SizedEnvelopedMessageRecord(Size=len(payload), Payload=payload).to_bytes()
+
+
+def message_payload(obj):
+    """Returns the payload of a received message or None at the end"""
+    if obj.code == SizedEnvelopedMessageRecord.code:
+        return obj.Payload
+    elif obj.code == EndRecord.code:
+        return None
+    elif obj.code == FaultRecord.code:
+        raise IOError('Fault: {}'.format(obj.Fault))
+    raise IOError('Unexpected record {}'.format(obj))
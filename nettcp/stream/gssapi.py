@@ -6,67 +6,95 @@ from __future__ import print_function, unicode_literals, absolute_import
 import logging
 import gssapi
 from .negotiate import NegotiateStream
+from .framing import chunks, MessageBuffer, MessageReader
+from ..profiling import clock
 
 log = logging.getLogger(__name__ + '.GSSAPIStream')
 
 
-class GSSAPIStream:
-    def __init__(self, stream, server_name,
-                 flags=(gssapi.RequirementFlag.mutual_authentication |
-                        gssapi.RequirementFlag.confidentiality |
-                        gssapi.RequirementFlag.integrity)):
-        self._inner = NegotiateStream(stream)
+DEFAULT_FLAGS = (gssapi.RequirementFlag.mutual_authentication |
+                 gssapi.RequirementFlag.confidentiality |
+                 gssapi.RequirementFlag.integrity)
+
+
+class GSSAPIContext(object):
+    """Client security context, wraps messages without doing any I/O
+
+    Shared by GSSAPIStream and the asyncio stream.
+    """
+
+    def __init__(self, server_name, flags=DEFAULT_FLAGS):
         if isinstance(server_name, str):
             server_name = gssapi.Name(server_name, name_type=gssapi.NameType.hostbased_service)
         self.server_name = server_name
         self.flags = flags
         self.client_ctx = None
-        self._readcache = b''
+        # nettcp.profiling.Stages receiving the decrypt and encrypt times
+        self.read_stages = None
+        self.write_stages = None
 
-    def negotiate(self):
-        self.client_ctx = gssapi.SecurityContext(name=self.server_name, usage='initiate',
-                                                 flags=self.flags)
+    def step(self, token=b''):
+        """Returns the next token to send, complete tells if a reply is expected"""
+        if self.client_ctx is None:
+            self.client_ctx = gssapi.SecurityContext(name=self.server_name, usage='initiate',
+                                                     flags=self.flags)
+        log.debug('Doing step')
+        token = self.client_ctx.step(token)
+        if self.client_ctx.complete:
+            log.debug('GSSAPI Handshake done')
+        return token
+
+    @property
+    def complete(self):
+        return self.client_ctx is not None and self.client_ctx.complete
+
+    def wrap(self, data):
+        """Returns the encrypted messages of data"""
+        return [self.encrypt(d) for d in chunks(data, 0xFC00)]
+
+    def encrypt(self, data):
+        if self.write_stages is None:
+            return self.client_ctx.encrypt(data)
+        start = clock()
+        data = self.client_ctx.encrypt(data)
+        self.write_stages.add('encrypt', clock() - start)
+        return data
+
+    def decrypt(self, data):
+        if self.read_stages is None:
+            return self.client_ctx.decrypt(data)
+        start = clock()
+        data = self.client_ctx.decrypt(data)
+        self.read_stages.add('decrypt', clock() - start)
+        return data
 
-        token = b''
-        while not self.client_ctx.complete:
-            log.debug('Doing step')
-            token = self.client_ctx.step(token)
 
-            self._inner.write(token)
-            if not self.client_ctx.complete:
-                token = self._inner.read()
-            else:
-                log.debug('GSSAPI Handshake done')
+class GSSAPIStream(GSSAPIContext, MessageReader):
+    def __init__(self, stream, server_name, flags=DEFAULT_FLAGS, max_read=None):
+        GSSAPIContext.__init__(self, server_name, flags)
+        self._inner = NegotiateStream(stream)
+        self._readcache = MessageBuffer()
+        self.max_read = max_read
+
+    def negotiate(self):
+        self._inner.write(self.step())
+        while not self.complete:
+            self._inner.write(self.step(self._inner.read()))
 
     def write(self, data):
         if not self.client_ctx:
             self.negotiate()
 
-        while data:
-            data2 = data[:0xFC00]
-            e_data = self.client_ctx.encrypt(data2)
+        for e_data in self.wrap(data):
             self._inner.write(e_data)
-            data = data[0xFC00:]
 
     def read(self, count=None):
         if not self.client_ctx:
             self.negotiate()
+        return MessageReader.read(self, count)
 
-        if count is None:
-            sub = self._inner.read()
-            return self.client_ctx.decrypt(sub)
-
-        while count > 0:
-            data = self._readcache[:count]
-            self._readcache = self._readcache[count:]
-            ld = len(data)
-            log.debug('Got %d bytes from cache', ld)
-            count -= ld
-            if count:
-                log.debug('Still %d bytes missing', count)
-                sub = self._inner.read()
-                self._readcache += self.client_ctx.decrypt(sub)
-        return data
+    def _next_message(self):
+        return self.decrypt(self._inner.read())
 
     def close(self):
         self._inner.close()
@@ -6,6 +6,7 @@ from __future__ import print_function, unicode_literals, absolute_import
 import enum
 import struct
 from ..nmf import Record
+from .framing import chunks, MessageBuffer, MessageReader
 import logging
 
 log = logging.getLogger(__name__ + '.NegotiateStream')
@@ -21,7 +22,7 @@ class Handshake(Record):
     _records = {}
 
 
-class HandshakeDone(Record):
+class HandshakeDone(Handshake):
     code = MessageType.HANDSHAKE_DONE
     fields = [
         ('major', 'B'),
@@ -37,45 +38,66 @@ class HandshakeError(HandshakeDone):
 class HandshakeInProgress(HandshakeDone):
     code = MessageType.HANDSHAKE_IN_PROGRESS
 
-Handshake.register(HandshakeInProgress)
-Handshake.register(HandshakeDone)
-Handshake.register(HandshakeError)
 
+class NNSFramer(object):
+    """[MS-NNS] framing without I/O, shared with the asyncio stream
 
-class NegotiateStream:
-    def __init__(self, stream):
-        self._inner = stream
-        self._handshake_done = False
+    Reading is header_size() bytes for parse_header(), then as many bytes as
+    it returned for parse_payload().
+    """
 
-    def write(self, data):
-        if not self._handshake_done:
+    def __init__(self):
+        self.handshake_done = False
+        self._error = False
+
+    def header_size(self):
+        return 4 if self.handshake_done else 5
+
+    def parse_header(self, header):
+        """Returns the size of the payload following the header"""
+        if self.handshake_done:
+            return struct.unpack('<I', header)[0]
+
+        _, message = Handshake.parse(header)
+        if message.code == int(MessageType.HANDSHAKE_ERROR):
+            self._error = True
+        elif message.code == int(MessageType.HANDSHAKE_DONE):
+            self.handshake_done = True
+            log.debug('NNS Handshake done')
+        return message.payload_size
+
+    def parse_payload(self, payload):
+        if self._error:
+            error = 'unknown'
+            if len(payload) >= 8:
+                error = '{:08x}'.format(struct.unpack('>II', payload[:8])[1])
+            raise IOError("Negotiate Error: {}".format(error))
+        return payload
+
+    def encode(self, data):
+        if not self.handshake_done:
             handshake = HandshakeInProgress(
                                 major=1,
                                 minor=0,
                                 payload_size=len(data)
                             ).to_bytes()
-            self._inner.write(handshake + data)
-        else:
-            while data:
-                # See [MS-NNS] 2.2.2 Data Message v8.0 for length
-                data2 = data[:0xFC30]
-                self._inner.write(struct.pack('<I', len(data2)) + data2)
-                data = data[0xFC30:]
-
-    def read(self, count=None):
-        if not self._handshake_done:
-            _, message = Handshake.parse(self._inner.read(5))
-
-            if message.code == int(MessageType.HANDSHAKE_ERROR):
-                error = None
-                if message.payload_size > 0:
-                    error = struct.unpack('>II', self._inner.read(8))[1]
-                raise IOError("Negotiate Error: {:08x}".format(error))
-            elif message.code == int(MessageType.HANDSHAKE_DONE):
-                self._handshake_done = True
-                log.debug('NNS Handshake done')
-
-            return self._inner.read(message.payload_size)
-        else:
-            payload_size = struct.unpack('<I', self._inner.read(4))[0]
-            return self._inner.read(payload_size)
+            return handshake + data
+        # See [MS-NNS] 2.2.2 Data Message v8.0 for length
+        return b''.join(struct.pack('<I', len(d)) + d for d in chunks(data, 0xFC30))
+
+
+class NegotiateStream(MessageReader):
+    def __init__(self, stream):
+        self._inner = stream
+        self._framer = NNSFramer()
+        self._readcache = MessageBuffer()
+
+    def write(self, data):
+        self._inner.write(self._framer.encode(data))
+
+    def _next_message(self):
+        size = self._framer.parse_header(self._inner.read(self._framer.header_size()))
+        return self._framer.parse_payload(self._inner.read(size) if size else b'')
+
+    def close(self):
+        self._inner.close()
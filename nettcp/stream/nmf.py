@@ -1,59 +1,52 @@
 #!/usr/bin/env python3
 # encoding: utf-8
 # Copyright 2016 Timo Schmid
-from ..nmf import (PreambleEndRecord, ViaRecord, VersionRecord,
-                   ModeRecord, KnownEncodingRecord, UpgradeRequestRecord,
-                   UpgradeResponseRecord, Record, register_types,
-                   SizedEnvelopedMessageRecord, PreambleAckRecord, EndRecord)
-from .gssapi import GSSAPIStream
+from ..nmf import PreambleEndRecord, UpgradeResponseRecord, PreambleAckRecord, EndRecord
+from .framing import (MessageBuffer, MessageReader, RecordReader, preamble, upgrade_request,
+                      expect, envelope, message_payload)
 
 
-class NMFStream:
-    def __init__(self, stream, url, server_name=None):
+class NMFStream(MessageReader):
+    def __init__(self, stream, url, server_name=None, max_buffer=None):
         self._inner = stream
         self._server_name = server_name
+        self._records = RecordReader(max_buffer)
+        self._readcache = MessageBuffer()
         self.url = url
 
-        register_types()
-
     def preamble(self):
-        data = [
-            VersionRecord(MajorVersion=1, MinorVersion=0),
-            ModeRecord(Mode=2),
-            ViaRecord(ViaLength=len(self.url), Via=self.url),
-            KnownEncodingRecord(Encoding=8),
-        ]
-
-        self._inner.write(b''.join(d.to_bytes() for d in data))
+        self._inner.write(preamble(self.url))
 
         if self._server_name:
-            msg = UpgradeRequestRecord(UpgradeProtocolLength=21,
-                                       UpgradeProtocol='application/negotiate').to_bytes()
-            self._inner.write(msg)
-            d = self._inner.read(1)
-            if d != UpgradeResponseRecord().to_bytes():
-                raise IOError('Negotiate not supported')
+            self._inner.write(upgrade_request())
+            expect(self._inner.read(1), UpgradeResponseRecord, 'Negotiate not supported')
 
+            from .gssapi import GSSAPIStream
             self._inner = GSSAPIStream(self._inner, self._server_name)
 
         self._inner.write(PreambleEndRecord().to_bytes())
 
-        if self._inner.read(1) != PreambleAckRecord().to_bytes():
-            raise IOError('Preamble end not acked')
+        expect(self._inner.read(1), PreambleAckRecord, 'Preamble end not acked')
 
     def write(self, data):
-        msg = SizedEnvelopedMessageRecord(Size=len(data), Payload=data)
-        self._inner.write(msg.to_bytes())
-
-    def read(self, count=None):
-        if count:
-            data = self._inner.read(count)
-            s, msg = Record.parse(data)
-            return data[s:msg.Size+s]
-        else:
-            msg = Record.parse_stream(self._inner)
-
-            return msg.Payload
+        self._inner.write(envelope(data))
+
+    def wait(self, timeout=None):
+        if self._records.complete():
+            return True
+        return MessageReader.wait(self, timeout)
+
+    def read_record(self):
+        """Returns the next record as (bytes, record)"""
+        result = self._records.read()
+        while result is None:
+            self._records.feed(self._inner.read())
+            result = self._records.read()
+        return result
+
+    def _next_message(self):
+        """Returns the payload of the next message or None at the end"""
+        return message_payload(self.read_record()[1])
 
     def close(self):
         self._inner.write(EndRecord().to_bytes())
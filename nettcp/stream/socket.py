@@ -3,51 +3,132 @@
 # Copyright 2016 Timo Schmid
 from __future__ import print_function, unicode_literals, absolute_import
 
+import errno
 import select
+import socket
 import logging
-import warnings
 import sys
-try:
-    from helperlib import print_hexdump
-except ImportError:
-    warnings.warn('python-helperlib not installed, no hexdump available (https://github.com/bluec0re/python-helperlib)')
-    print_hexdump = False
+
+from ..hexdump import get_print_hexdump
+from ..profiling import clock
 
 log = logging.getLogger(__name__ + '.SocketStream')
 
+_MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+
+class ConnectionClosed(IOError):
+    pass
+
+
+class BufferLimitExceeded(IOError):
+    pass
+
+
+def wait_socket(sock, timeout, write=False):
+    """Waits until sock is readable (or writable), returns False on timeout"""
+    try:
+        if hasattr(select, 'poll'):
+            # unlike select, poll is not limited to FD_SETSIZE descriptors
+            poller = select.poll()
+            poller.register(sock, select.POLLOUT if write else select.POLLIN)
+            return bool(poller.poll(None if timeout is None else timeout * 1000))
+
+        if write:
+            _, ready, _ = select.select([], [sock], [], timeout)
+        else:
+            ready, _, _ = select.select([sock], [], [], timeout)
+        return bool(ready)
+    except ValueError:
+        # the socket was closed by the thread of the other direction
+        raise ConnectionClosed('Socket closed')
+
+
+def dump(title, data):
+    if log.isEnabledFor(logging.DEBUG) and get_print_hexdump() is not False:
+        log.debug(title)
+        get_print_hexdump()(data, colored=True, file=sys.stderr)
+
 
 class SocketStream:
-    def __init__(self, socket):
+    def __init__(self, socket, read_timeout=None, write_timeout=None, max_read=None):
         self._socket = socket
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.max_read = max_read
+        # nettcp.profiling.Stages receiving the recv and send times
+        self.read_stages = None
+        self.write_stages = None
+
+    def wait(self, timeout=None):
+        return wait_socket(self._socket, timeout)
 
     def read(self, count=None):
+        if self.read_stages is None:
+            return self._read(count)
+        start = clock()
+        try:
+            return self._read(count)
+        finally:
+            self.read_stages.add('recv', clock() - start)
+
+    def _read(self, count):
         data = None
         if count is None:
             self._socket.setblocking(0)
-            rs = [self._socket]
-            rs, _, _ = select.select(rs, [], [])
-            if rs:
-                data = rs[0].recv(4096)
+            if wait_socket(self._socket, self.read_timeout):
+                data = self._socket.recv(4096)
+            else:
+                raise socket.timeout('read timed out')
+            if not data:
+                raise ConnectionClosed('Connection closed by peer')
         else:
+            if self.max_read is not None and count > self.max_read:
+                raise BufferLimitExceeded('Refusing to buffer {} bytes (limit {})'.format(
+                    count, self.max_read))
+
             self._socket.setblocking(1)
-            data = b''
+            parts = []
             while count:
+                if self.read_timeout is not None and \
+                        not wait_socket(self._socket, self.read_timeout):
+                    raise socket.timeout('read timed out')
                 d = self._socket.recv(count)
+                if not d:
+                    raise ConnectionClosed('Connection closed by peer')
                 count -= len(d)
-                data += d
+                parts.append(d)
+            data = parts[0] if len(parts) == 1 else b''.join(parts)
 
-        if log.isEnabledFor(logging.DEBUG) and print_hexdump is not False:
-            log.debug('Recved Data:')
-            print_hexdump(data, colored=True, file=sys.stderr)
+        dump('Recved Data:', data)
         return data
 
     def write(self, data):
-        if log.isEnabledFor(logging.DEBUG) and print_hexdump is not False:
-            log.debug('Sent Data:')
-            print_hexdump(data, colored=True, file=sys.stderr)
+        dump('Sent Data:', data)
 
+        if self.write_stages is None:
+            return self._write(data)
+        start = clock()
+        try:
+            return self._write(data)
+        finally:
+            self.write_stages.add('send', clock() - start)
+
+    def _write(self, data):
         self._socket.setblocking(1)
-        self._socket.sendall(data)
+        if self.write_timeout is None:
+            self._socket.sendall(data)
+            return
+
+        view = memoryview(data)
+        while view:
+            if not wait_socket(self._socket, self.write_timeout, write=True):
+                raise socket.timeout('write timed out')
+            try:
+                view = view[self._socket.send(view, _MSG_DONTWAIT):]
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
 
     def close(self):
         # self._socket.shutdown()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+# Copyright 2016 Timo Schmid
+"""Trace files written by the proxy
+
+Every line holds one record: timestamp, client address, direction and the
+hex encoded record, separated by tabs. Old traces only contain the last two
+columns.
+
+The proxy writes either all connections into one file (SharedTrace) or every
+connection into its own file (ConnectionTraces). Both rotate a file after
+max_bytes or max_age seconds, the finished segments are renamed to
+<name>.1, <name>.2, ...
+
+SampledTrace wraps either of them to only trace some of the connections or
+the start of every connection.
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import sys
+import time
+import random
+import datetime
+import threading
+from binascii import a2b_hex, b2a_hex
+
+__all__ = [
+    'parse_line',
+    'format_line',
+    'parse_timestamp',
+    'TraceFile',
+    'SharedTrace',
+    'ConnectionTraces',
+    'SampledTrace',
+]
+
+VIA_CODE = b'\x02'
+# records a client sends before the Via
+MAX_PREAMBLE = 4
+
+
+def parse_timestamp(value):
+    """Returns the seconds since the epoch of a trace timestamp (local time)"""
+    try:
+        dt = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+    except ValueError:
+        dt = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    return time.mktime(dt.timetuple()) + dt.microsecond / 1e6
+
+
+def parse_line(line):
+    """Returns (timestamp, connection, direction, data), timestamp may be None"""
+    parts = line.strip().split('\t')
+    if len(parts) == 2:
+        timestamp, connection, direction, data = [None, '?'] + parts
+    else:
+        timestamp, connection, direction, data = parts
+        timestamp = parse_timestamp(timestamp)
+    return timestamp, connection, direction, a2b_hex(data)
+
+
+def format_line(timestamp, client_address, direction, data):
+    return '{}\t{}:{}\t{}\t{}\n'.format(datetime.datetime.fromtimestamp(timestamp),
+                                        client_address[0], client_address[1],
+                                        direction, b2a_hex(data).decode())
+
+
+class TraceFile(object):
+    """Trace file which is rotated after max_bytes or max_age seconds
+
+    Only the newest backups rotated segments are kept if backups is given.
+    """
+
+    def __init__(self, path, max_bytes=None, max_age=None, backups=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backups = backups
+        self.segment = 0
+        self.lock = threading.Lock()
+        self.fp = None
+        if path != '-' and (max_bytes is not None or max_age is not None):
+            # continue after the segments of an earlier run, the file it was
+            # writing becomes the next one
+            segments = self._segments()
+            if segments:
+                self.segment = segments[-1]
+            if os.path.exists(path) and os.path.getsize(path):
+                self._rename()
+        self._open()
+
+    def _segments(self):
+        """Numbers of the rotated segments on disk"""
+        directory, name = os.path.split(self.path)
+        prefix = name + '.'
+        return sorted(int(entry[len(prefix):]) for entry in os.listdir(directory or '.')
+                      if entry.startswith(prefix) and entry[len(prefix):].isdigit())
+
+    def _open(self):
+        if self.path == '-':
+            self.fp = sys.stdout
+            self.max_bytes = self.max_age = None
+        else:
+            self.fp = open(self.path, 'w')
+        self.size = 0
+        self.opened = time.time()
+
+    def _due(self, now):
+        return ((self.max_bytes is not None and self.size >= self.max_bytes) or
+                (self.max_age is not None and now - self.opened >= self.max_age))
+
+    def _rename(self):
+        self.segment += 1
+        os.rename(self.path, '{}.{}'.format(self.path, self.segment))
+        if self.backups is not None:
+            for segment in self._segments():
+                if segment > self.segment - self.backups:
+                    break
+                try:
+                    os.remove('{}.{}'.format(self.path, segment))
+                except OSError:
+                    pass
+
+    def rotate(self):
+        self.fp.close()
+        self._rename()
+        self._open()
+
+    def write(self, line, now):
+        with self.lock:
+            if self.size and self._due(now):
+                self.rotate()
+            self.fp.write(line)
+            self.fp.flush()
+            self.size += len(line)
+
+    def close(self):
+        with self.lock:
+            if self.fp is not sys.stdout:
+                self.fp.close()
+
+
+class TraceSession(object):
+    """Writes the records of one connection"""
+
+    def __init__(self, trace_file, client_address, owned=False):
+        self.trace_file = trace_file
+        self.client_address = client_address
+        self.owned = owned
+
+    def write(self, direction, data, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        self.trace_file.write(format_line(timestamp, self.client_address, direction, data),
+                              timestamp)
+
+    def close(self):
+        if self.owned:
+            self.trace_file.close()
+
+
+class SharedTrace(object):
+    """All connections in one trace file"""
+
+    def __init__(self, path, max_bytes=None, max_age=None, backups=None):
+        self.trace_file = TraceFile(path, max_bytes, max_age, backups)
+
+    def session(self, client_address):
+        return TraceSession(self.trace_file, client_address)
+
+    def close(self):
+        self.trace_file.close()
+
+
+class ConnectionTraces(object):
+    """One trace file per connection, no lock is shared between them"""
+
+    def __init__(self, directory, max_bytes=None, max_age=None, backups=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backups = backups
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, client_address):
+        name = '{}_{}_{}.trace'.format(datetime.datetime.today().strftime('%Y%m%d-%H%M%S.%f'),
+                                       client_address[0].replace(':', '-'), client_address[1])
+        return os.path.join(self.directory, name)
+
+    def session(self, client_address):
+        trace_file = TraceFile(self.path(client_address), self.max_bytes, self.max_age,
+                               self.backups)
+        return TraceSession(trace_file, client_address, owned=True)
+
+    def close(self):
+        pass
+
+
+class SampledTrace(object):
+    """Traces a sample of the connections of another trace
+
+    rate is the fraction of connections traced, decided when the connection
+    is accepted. Of every traced connection only the first max_records
+    records and max_bytes bytes are written. With via_prefix only
+    connections to a matching Via are traced.
+    """
+
+    def __init__(self, trace, rate=None, max_records=None, max_bytes=None, via_prefix=None):
+        self.trace = trace
+        self.rate = rate
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.via_prefix = via_prefix
+
+    def session(self, client_address):
+        if self.rate is not None and random.random() >= self.rate:
+            return None
+        return SampledSession(self, client_address)
+
+    def close(self):
+        self.trace.close()
+
+
+class SampledSession(object):
+    def __init__(self, sampled, client_address):
+        self.sampled = sampled
+        self.client_address = client_address
+        self.lock = threading.Lock()
+        self.records = 0
+        self.bytes = 0
+        self.done = False
+        self.session = None
+        # records seen before the Via decided about the connection
+        self.preamble = []
+        if sampled.via_prefix is None:
+            self.session = sampled.trace.session(client_address)
+
+    def _match_via(self, data):
+        from .nmf import Record
+
+        via = Record.parse(data)[1].Via
+        if via.startswith(self.sampled.via_prefix):
+            self.session = self.sampled.trace.session(self.client_address)
+            preamble, self.preamble = self.preamble, None
+            for args in preamble:
+                self._write(*args)
+        else:
+            self.done = True
+            self.preamble = None
+
+    def write(self, direction, data, timestamp=None):
+        if self.done:
+            return
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            # the other direction may have finished the session meanwhile
+            if self.done:
+                return
+            if self.session is not None:
+                self._write(direction, data, timestamp)
+                return
+
+            self.preamble.append((direction, data, timestamp))
+            if data[:1] == VIA_CODE:
+                self._match_via(data)
+            elif len(self.preamble) > MAX_PREAMBLE:
+                # no Via, nothing to match
+                self.done = True
+                self.preamble = None
+
+    def _write(self, direction, data, timestamp):
+        if self.done:
+            return
+        self.records += 1
+        self.bytes += len(data)
+        if ((self.sampled.max_records is not None and self.records > self.sampled.max_records) or
+                (self.sampled.max_bytes is not None and self.bytes > self.sampled.max_bytes)):
+            self._close()
+            return
+        self.session.write(direction, data, timestamp)
+
+    def _close(self):
+        self.done = True
+        self.preamble = None
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def close(self):
+        with self.lock:
+            self._close()
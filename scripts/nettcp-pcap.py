@@ -0,0 +1,5 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+from nettcp.pcap import main
+
+main()
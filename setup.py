@@ -13,5 +13,7 @@ setup(name='nettcp',
         'scripts/decode-nmf.py',
         'scripts/decode-wcfbin.py',
         'scripts/nettcp-proxy.py',
+        'scripts/nettcp-stats.py',
+        'scripts/nettcp-pcap.py',
       ]
       )